@@ -0,0 +1,15 @@
+#!/usr/bin/env bash
+
+# Get real directory in case of symlink
+if [[ -L "${BASH_SOURCE[0]}" ]]
+then
+  DIR="$( cd "$( dirname $( readlink "${BASH_SOURCE[0]}" ) )" && pwd )"
+else
+  DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+fi
+cd $DIR
+cd ..
+source $DIR/envvar
+
+# exec, so that SIGTERM from the service manager reaches the daemon directly.
+exec flask run_daemon
@@ -1,7 +1,9 @@
 from flask import Flask, render_template, request, jsonify
 from leaguebot import app
 from slackclient import SlackClient
+import leaguebot.routes.benchmarks
 import leaguebot.routes.cli
+import leaguebot.routes.replay
 import leaguebot.routes.slashes
 
 @app.route('/')
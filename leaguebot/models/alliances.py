@@ -0,0 +1,140 @@
+"""
+The alliance index: which alliance each player is in, and who is in each alliance, from LOAN's alliances.js.
+
+alliances.js is fetched by at most one thread per process, with a conditional request, and only the alliances which
+changed are written to redis. Each process keeps its own copy of the index, which is rebuilt only when the version in
+redis changes.
+"""
+import threading
+
+from requests.exceptions import RequestException
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from leaguebot import app
+from leaguebot.services import http_client, redis_data
+
+__all__ = ["AllianceIndex", "get_alliance_index", "refresh_alliance_data"]
+
+ALLIANCES_URL = app.config['LOAN_URL'] + "alliances.js"
+
+# Seconds between checks for new alliance data (unchanged data isn't downloaded again).
+app.config.setdefault('ALLIANCE_REFRESH_SECONDS', 60 * 10)
+
+logger = app.logger
+
+
+class AllianceIndex(object):
+    """
+    One version of the alliance data, with lookups both ways. It's shared between threads, so it must not be modified.
+    """
+
+    def __init__(self, version, alliances):
+        """
+        :param alliances: A dict of abbreviation to {'name': ..., 'members': [...]}.
+        """
+        self.version = version
+        self.names = {}
+        self.members = {}
+        self.by_username = {}
+        for abbreviation, alliance in alliances.items():
+            self.names[abbreviation] = alliance['name']
+            self.members[abbreviation] = frozenset(alliance['members'])
+            for member in alliance['members']:
+                self.by_username[member] = abbreviation
+
+    def get_alliance(self, username):
+        """
+        :return: The abbreviation of the user's alliance, or None if they aren't in one.
+        """
+        return self.by_username.get(username)
+
+    def get_alliance_name(self, abbreviation):
+        """
+        :return: The alliance's full name, or None if there's no such alliance.
+        """
+        return self.names.get(abbreviation)
+
+    def get_members(self, abbreviation):
+        """
+        :return: The usernames of the alliance's members.
+        :rtype: frozenset[str]
+        """
+        return self.members.get(abbreviation, frozenset())
+
+
+def _normalize(json_root):
+    """
+    :return: A dict of abbreviation to {'name': ..., 'members': [...]}, with members sorted so that unchanged alliances
+             compare equal.
+    """
+    return {abbreviation: {'name': alliance['name'], 'members': sorted(alliance['members'])}
+            for abbreviation, alliance in json_root.items()}
+
+
+def refresh_alliance_data(current_alliances):
+    """
+    Fetches alliances.js if it has changed, and writes whichever alliances changed to redis.
+    :param current_alliances: The alliances currently stored, as returned by redis_data.get_alliance_data.
+    """
+    expire = app.config['ALLIANCE_REFRESH_SECONDS']
+    validators = redis_data.get_alliance_data_validators() if current_alliances else {}
+    headers = {}
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last-modified' in validators:
+        headers['If-Modified-Since'] = validators['last-modified']
+    try:
+        result = http_client.get(ALLIANCES_URL, headers=headers)
+    except (NewConnectionError, RequestException):
+        logger.exception("Error getting {}.".format(ALLIANCES_URL))
+        redis_data.mark_alliance_data_fetched(expire)  # keep the current data, and try again later.
+        return
+    if result.status_code == 304:
+        redis_data.mark_alliance_data_fetched(expire)
+        return
+    try:
+        json_root = result.json()
+    except ValueError:
+        json_root = None
+    if not result.ok or json_root is None:
+        logger.error("Error parsing alliance data as json. {} ({}, at {})"
+                     .format(result.text, result.status_code, result.url))
+        redis_data.mark_alliance_data_fetched(expire)
+        return
+
+    new_alliances = _normalize(json_root)
+    changed = {abbreviation: alliance for abbreviation, alliance in new_alliances.items()
+               if current_alliances.get(abbreviation) != alliance}
+    removed = [abbreviation for abbreviation in current_alliances if abbreviation not in new_alliances]
+    validators = {name: result.headers[name] for name in ('etag', 'last-modified') if name in result.headers}
+    version = redis_data.update_alliance_data(changed, removed, validators, expire)
+    if changed or removed:
+        logger.info("Alliance data version {}: {} alliances added or changed, {} removed."
+                    .format(version, len(changed), len(removed)))
+
+
+_alliance_index = AllianceIndex(0, {})
+_alliance_index_lock = threading.Lock()
+_alliance_refresh_lock = threading.Lock()
+
+
+def get_alliance_index():
+    """
+    Gets the current alliance index, fetching new alliance data first if it's due.
+    :rtype: AllianceIndex
+    """
+    global _alliance_index
+    is_recent, version = redis_data.get_alliance_data_status()
+    if not is_recent:
+        with _alliance_refresh_lock:
+            # Another thread may have refreshed it while we were waiting.
+            is_recent, version = redis_data.get_alliance_data_status()
+            if not is_recent:
+                refresh_alliance_data(redis_data.get_alliance_data()[1] if version else {})
+                is_recent, version = redis_data.get_alliance_data_status()
+    with _alliance_index_lock:
+        if _alliance_index.version != version:
+            _alliance_index = AllianceIndex(*redis_data.get_alliance_data())
+            logger.debug("Loaded alliance data version {} ({} alliances, {} users).".format(
+                _alliance_index.version, len(_alliance_index.names), len(_alliance_index.by_username)))
+        return _alliance_index
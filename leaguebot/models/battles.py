@@ -4,13 +4,11 @@ from leaguebot.services import screeps, redis_data, redis_queue
 
 
 def get_battles(since_tick=None, interval=None):
-    client = screeps.get_client()
-    return client.battles(start=since_tick, interval=interval)
+    return screeps.api_get('experimental/pvp', start=since_tick, interval=interval)
 
 
 def get_nukes():
-    client = screeps.get_client()
-    return client.nukes()['nukes']
+    return screeps.api_get('experimental/nukes')['nukes']
 
 
 def check_and_queue_battles_once():
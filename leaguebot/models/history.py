@@ -1,46 +1,77 @@
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from requests.exceptions import RequestException
 from requests.packages.urllib3.exceptions import NewConnectionError
 
 from leaguebot import app
 from leaguebot.models import user_info
-from leaguebot.services import redis_data, redis_queue
+from leaguebot.services import history_cache, history_parser, http_client, redis_data, redis_queue, screeps
 from leaguebot.static_constants import ScreepsError
-from leaguebot.static_constants import scout, civilian, general_attacker, dismantling_attacker, healer, melee_attacker, \
-    ranged_attacker, tough_attacker, work_and_carry_attacker, KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL
+from leaguebot.static_constants import scout, civilian, general_attacker, dismantling_attacker, healer, \
+    melee_attacker, ranged_attacker, tough_attacker, work_and_carry_attacker, KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL
 
-_URL_ROOT = "https://screeps.com/"
+_URL_ROOT = app.config['SCREEPS_URL']
 
 USERNAME_URL_FORMAT = _URL_ROOT + "api/user/find"
 HISTORY_URL_FORMAT = _URL_ROOT + "room-history/{room}/{tick}.json"
 BATTLES_URL_FORMAT = _URL_ROOT + "api/experimental/pvp"
 
-ALLIANCES_URL = "http://www.leagueofautomatednations.com/alliances.js"
+ALLIANCES_URL = app.config['LOAN_URL'] + "alliances.js"
 
 logger = app.logger
 
+app.config.setdefault('PROCESSING_WORKERS', 1)
+# Maximum number of history segments fetched at once while searching forward through a single battle.
+app.config.setdefault('HISTORY_PREFETCH_WINDOW', 8)
+# Maximum number of history segments being fetched at once, across all rooms.
+app.config.setdefault('HISTORY_FETCH_WORKERS', 16)
+# How to search back for the start of a battle: 'galloping' (exponential then binary search, then fetching every segment
+# inside the battle at once) or 'linear' (one segment at a time).
+app.config.setdefault('HISTORY_SEARCH_BACK_MODE', 'galloping')
+
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
 
-def grab_history(room, tick):
+def grab_history(room, tick, current_tick=None):
     """
     Grabs history. TODO: use screeps-api for this.
 
     Currently this custom function is used instead of the screeps-api package's function in order to have custom
     handling of the 404 error case, and the case where invalid JSON is returned.
 
+    Only the parts of each segment used by modify_data_with_history are decoded, see history_parser.
+
+    Successfully retrieved segments never change, so they're stored in the history cache and only fetched once.
+    Missing segments are remembered as well, see history_cache.is_known_missing.
+
     :param room: room to grab
     :param tick: tick to grab, must be interval of 20
+    :param current_tick: the latest known game tick, if known. Segments which recently returned 404 errors aren't
+        requested again until the game has moved far enough past them for them to plausibly exist.
     :return: None if the result is an error 404, otherwise the json result output. If the URL returns 200, but has
         invalid json, a empty dummy object is returned.
     :rtype: None | dict[str, Any]
     :raises ScreepsError: if a non-OK non-404 result is returned
     """
+    cached = history_cache.get(room, tick)
+    if cached is not None:
+        return history_parser.parse_history(cached)
+    if current_tick and history_cache.is_known_missing(room, tick, current_tick):
+        return None
+
     url = HISTORY_URL_FORMAT.format(room=room, tick=tick)
     try:
-        result = requests.get(url)
-    except NewConnectionError as e:
-        logger.exception("NewConnectionError getting {}".format(url))
+        result = http_client.get(url)
+    except (NewConnectionError, RequestException) as e:
+        logger.exception("Connection error getting {}".format(url))
         raise ScreepsError("{} ({}, at {})".format(e, 'error', url))
     if not result.ok:
         if result.status_code == 404:
+            if current_tick:
+                history_cache.mark_missing(room, tick, current_tick)
             return None
         raise ScreepsError("{} ({}, at {})".format(result.text, result.status_code, result.url))
 
@@ -52,40 +83,186 @@ def grab_history(room, tick):
         return {'ticks': {}}
 
     try:
-        json = result.json()
+        history_json = history_parser.parse_history(result.content)
     except ValueError:
         logger.exception("Invalid JSON data from {} ({}). Ignoring, and returning an empty data set."
                          .format(result.url, result.text))
         return {'ticks': {}}
 
-    if not json:
+    if not history_json:
         raise ScreepsError("Invalid json: {} ({}, at {})".format(result.text, result.status_code, result.url))
 
-    return json
+    # Only complete, valid segments are cached, so that anything else is retried the next time it's needed.
+    history_cache.put(room, tick, result.content)
+    return history_json
+
+
+def _grab_history_or_none(room, tick, current_tick=None):
+    """
+    Same as grab_history, but logs and returns None on unexpected errors as well as on 404 errors.
+    """
+    try:
+        return grab_history(room, tick, current_tick)
+    except ScreepsError:
+        logger.exception("Error grabbing history")
+        return None
+
+
+def _grab_history_or_none_in_context(room, tick, current_tick):
+    """
+    Same as _grab_history_or_none, but pushes an app context first so that it can be run from a worker thread.
+    """
+    with app.app_context():
+        return _grab_history_or_none(room, tick, current_tick)
+
+
+def _get_fetch_executor():
+    """
+    Gets the thread pool shared by all history prefetching, so that the total number of concurrent fetches stays bounded
+    even when many rooms are processed at once.
+    :rtype: ThreadPoolExecutor
+    """
+    global _fetch_executor
+    if _fetch_executor is None:
+        with _fetch_executor_lock:
+            if _fetch_executor is None:
+                _fetch_executor = ThreadPoolExecutor(max_workers=app.config['HISTORY_FETCH_WORKERS'])
+    return _fetch_executor
+
+
+def _grab_history_ahead(room, ticks, current_tick, already_fetched=None):
+    """
+    Fetches the history segments for all of the given ticks concurrently, yielding them in order.
+
+    Fetches which haven't started yet are cancelled once this generator is closed, so results which turn out not to be
+    needed (because the battle has ended) cost as little as possible.
+    :param already_fetched: An optional dict of tick to history result, for segments which don't need fetching again.
+    :return: A generator of (tick, history_result_or_none) tuples
+    """
+    executor = _get_fetch_executor()
+    futures = {}
+    for tick in ticks:
+        if already_fetched is None or tick not in already_fetched:
+            futures[tick] = executor.submit(_grab_history_or_none_in_context, room, tick, current_tick)
+    try:
+        for tick in ticks:
+            if tick in futures:
+                yield tick, futures[tick].result()
+            else:
+                yield tick, already_fetched[tick]
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+def _forward_window_ticks(battle_data, first_tick, current_tick):
+    """
+    Finds which history segments to fetch at once in the forward search loop, starting at first_tick.
+
+    The longer a battle has been running, the more likely it is to keep going, so the window grows with the battle's
+    length (up to HISTORY_PREFETCH_WINDOW segments). The window never goes further than the first segment past
+    stop_checking_at, nor speculates on segments which can't have been generated yet according to current_tick.
+    :return: A list of ticks, always containing at least first_tick.
+    """
+    segments_so_far = (first_tick - battle_data['earliest_hostilities_detected']) // 20
+    size = max(1, min(segments_so_far // 2, app.config['HISTORY_PREFETCH_WINDOW']))
+    ticks = [first_tick]
+    while len(ticks) < size:
+        last_tick = ticks[-1]
+        next_tick = last_tick + 20
+        if last_tick > battle_data['stop_checking_at'] or next_tick + 20 > current_tick:
+            break
+        ticks.append(next_tick)
+    return ticks
+
+
+def _search_back_galloping(room_name, battle_data, start_tick, start_result, current_tick):
+    """
+    Searches back from an initial segment which is known to be part of a battle, using O(log n) serial fetches to find
+    where the battle started, then fills in the data for all segments up to there in one concurrent batch.
+
+    The boundary is found by probing 1, 2, 4, 8... segments back until a peaceful or unavailable segment is found, then
+    binary searching between that and the last hostile segment. This assumes that battles don't have long peaceful
+    breaks in them, but the results don't depend on that: the segments are still applied to modify_data_with_history
+    one by one exactly as the linear search does, and if the battle turns out to continue past the boundary, it's up to
+    the caller to keep searching linearly from the returned tick.
+
+    :param start_tick: The tick of the initial segment, which has already been applied to battle_data.
+    :param start_result: The initial segment's history result.
+    :return: A tuple of (still_a_battle, last_tick_applied). still_a_battle is True only if the linear search should
+             continue from before last_tick_applied.
+    """
+    fetched = {start_tick: start_result}
+
+    def is_peaceful(segments_back):
+        tick = start_tick - 20 * segments_back
+        if tick < 0:
+            return True
+        if tick not in fetched:
+            fetched[tick] = _grab_history_or_none(room_name, tick, current_tick)
+        return fetched[tick] is None or _is_peaceful_section(fetched[tick])
+
+    hostile_offset = 0
+    peaceful_offset = 1
+    while not is_peaceful(peaceful_offset):
+        hostile_offset = peaceful_offset
+        peaceful_offset *= 2
+    while peaceful_offset - hostile_offset > 1:
+        middle = (hostile_offset + peaceful_offset) // 2
+        if is_peaceful(middle):
+            peaceful_offset = middle
+        else:
+            hostile_offset = middle
+    logger.debug("Found likely start of battle {} segments back after {} fetches."
+                 .format(peaceful_offset, len(fetched) - 1))
+
+    ticks = [start_tick - 20 * offset for offset in range(1, peaceful_offset + 1)]
+    tick_applied = start_tick
+    with closing(_grab_history_ahead(room_name, ticks, current_tick, fetched)) as results:
+        for tick, api_result in results:
+            if api_result is None:
+                return False, tick_applied
+            logger.debug("Successfully got tick {}".format(tick))
+            tick_applied = tick
+            if not modify_data_with_history(battle_data, api_result, checking='earliest'):
+                return False, tick_applied
+    return True, tick_applied
 
 
 def process_room(room_name, current_tick):
     """
     Works on room data stored in redis, returning data only when completely completed.
     :param room_name: The room name to work on
-    :param current_tick: The last tick retrieved from the API (not specific to this room, just the latest known tick)
+    :param current_tick: The current game tick (not specific to this room, just the latest known tick)
     :return: None if the room needs more processing later, otherwise a finished battle information dict
     """
+    return _process_room(room_name, current_tick)[0]
+
+
+def _process_room(room_name, current_tick):
+    """
+    Same as process_room, but also says which history segment is needed next when the room needs more processing.
+    :return: A tuple of (finished_battle_data, next_tick_needed). finished_battle_data is None if the room needs more
+             processing later, in which case next_tick_needed is the tick of the segment which couldn't be found yet.
+    """
     battle_data = redis_data.get_ongoing_data(room_name)
     if battle_data is None:
         logger.error("No ongoing data found for room {}! Abandoning."
                      .format(room_name))
-        return {}  # this will be caught by queuing, and be removed from the queue.
+        return {}, None  # this will be caught by queuing, and be removed from the queue.
 
     logger.debug("Started processing room {}.".format(room_name))
 
+    # Remember which creeps were already stored, so that only new ones need to be written back.
+    stored_creeps_found = frozenset(battle_data.get('creeps_found', ()))
+
     changed = False
     if 'tick_to_check' in battle_data:
         logger.debug("Running initial check on room {}.".format(room_name))
         # No info has been found so far, let's do the initial check!
         tick_to_call = battle_data['tick_to_check'] - battle_data['tick_to_check'] % 20
         try:
-            api_result = grab_history(room_name, tick_to_call)
+            api_result = grab_history(room_name, tick_to_call, current_tick)
         except ScreepsError:
             logger.exception("Error grabbing history")
             api_result = None  # None is already returned when the error is an expected 404 error.
@@ -94,7 +271,7 @@ def process_room(room_name, current_tick):
             if tick_to_call + KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL < current_tick:
                 logger.error("Room {} tick {} data has been unavailable for over {} ticks! Abandoning."
                              .format(room_name, tick_to_call, KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL))
-                return {
+                return ({
                     'max_tick_checked': battle_data['tick_to_check'],
                     'player_creep_counts': {},
                     'alliances': {},
@@ -104,16 +281,16 @@ def process_room(room_name, current_tick):
                     'earliest_hostilities_detected': battle_data['tick_to_check'],
                     'latest_hostilities_detected': battle_data['tick_to_check'] + 1,
                     'duration': 1,
-                }
+                }, None)
             else:
-                return None
+                return None, tick_to_call
 
         changed = True
 
         # First tick found! Let's modify the battle data to match this.
         battle_data['max_tick_checked'] = tick_to_call
         battle_data['player_creep_counts'] = {}
-        battle_data['creeps_found'] = []
+        battle_data['creeps_found'] = set()
         battle_data['owner'] = None
         battle_data['rcl'] = 0
         # Since this tick to check is pretty much coming from the initial API, we're going to assume a hostile action
@@ -135,47 +312,47 @@ def process_room(room_name, current_tick):
         # ticks!
 
         logger.debug("Starting search-back loop.")
-        while True:
-            # TODO: earliest_hostilities_collided check here!
-            # We process the result first in here so that we can use the result from the initial tick.
-            still_a_battle = modify_data_with_history(battle_data, api_result, checking='earliest')
-            if not still_a_battle:
-                break
+        # TODO: earliest_hostilities_collided check here!
+        # We process the result first in here so that we can use the result from the initial tick.
+        still_a_battle = modify_data_with_history(battle_data, api_result, checking='earliest')
+        if still_a_battle and app.config['HISTORY_SEARCH_BACK_MODE'] == 'galloping':
+            still_a_battle, tick_to_call = _search_back_galloping(room_name, battle_data, tick_to_call, api_result,
+                                                                 current_tick)
+        while still_a_battle:
             tick_to_call -= 20  # Search 20 further back in history.
-            try:
-                api_result = grab_history(room_name, tick_to_call)
-            except ScreepsError:
-                logger.exception("Error grabbing history")
-                api_result = None  # None is already returned when the error is an expected 404 error.
+            api_result = _grab_history_or_none(room_name, tick_to_call, current_tick)
             if api_result is None:
                 break
             logger.debug("Successfully got tick {}".format(tick_to_call))
+            still_a_battle = modify_data_with_history(battle_data, api_result, checking='earliest')
 
     # At this point, we know that the initial tick has been found. Now we're just continuing to check forward.
     tick_to_call = battle_data['max_tick_checked'] + 20
     found_end = False
     logger.debug("Starting forward search loop.")
     while True:
-        try:
-            api_result = grab_history(room_name, tick_to_call)
-        except ScreepsError:
-            logger.exception("Error grabbing history")
-            api_result = None  # None is already returned when the error is an expected 404 error.
-        if api_result is None:
-            break
-        logger.debug("Successfully got tick {}".format(tick_to_call))
-        still_a_battle = modify_data_with_history(battle_data, api_result, checking='latest')
-        battle_data['max_tick_checked'] = tick_to_call
-        changed = True
-        if not still_a_battle:
-            found_end = True
-            battle_data['battle_still_ongoing'] = False
-            break
-        elif tick_to_call > battle_data['stop_checking_at']:
-            found_end = True
-            battle_data['battle_still_ongoing'] = True
-            break
-        tick_to_call += 20
+        window = _forward_window_ticks(battle_data, tick_to_call, current_tick)
+        with closing(_grab_history_ahead(room_name, window, current_tick)) as results:
+            for tick_to_call, api_result in results:
+                if api_result is None:
+                    break
+                logger.debug("Successfully got tick {}".format(tick_to_call))
+                still_a_battle = modify_data_with_history(battle_data, api_result, checking='latest')
+                battle_data['max_tick_checked'] = tick_to_call
+                changed = True
+                if not still_a_battle:
+                    found_end = True
+                    battle_data['battle_still_ongoing'] = False
+                    break
+                elif tick_to_call > battle_data['stop_checking_at']:
+                    found_end = True
+                    battle_data['battle_still_ongoing'] = True
+                    break
+            else:
+                # Every segment in the window was found, and the battle is still going: move on to the next window.
+                tick_to_call += 20
+                continue
+        break
 
     if found_end:
         logger.debug("Ended. Found end{}, submitting!"
@@ -186,17 +363,42 @@ def process_room(room_name, current_tick):
         del battle_data['max_tick_checked']
         battle_data['duration'] = battle_data['latest_hostilities_detected'] \
                                   - battle_data['earliest_hostilities_detected'] + 1
-        battle_data['alliances'] = {}
-        for username in battle_data['player_creep_counts'].keys():
-            battle_data['alliances'][username] = user_info.alliance_from_username(username)
+        battle_data['alliances'] = user_info.alliances_from_usernames(battle_data['player_creep_counts'].keys())
         battle_data['room'] = room_name
-        return battle_data
+        return battle_data, None
     else:
         logger.debug("Ended, but still searching!")
         if changed:
-            redis_data.set_ongoing_data(room_name, battle_data)
+            redis_data.set_ongoing_data(room_name, battle_data, battle_data['creeps_found'] - stored_creeps_found)
 
-        return None
+        return None, tick_to_call
+
+
+def _find_user_ids_to_resolve(battle_data, history_result):
+    """
+    Finds the IDs of every user whose username modify_data_with_history could need for this history result, so that
+    they can all be looked up at once.
+    :return: A set of user IDs.
+    """
+    user_ids = set()
+    creeps_found = battle_data['creeps_found']
+    need_owner = battle_data['owner'] is None
+    for tick_data in history_result['ticks'].values():
+        for creep_id, obj_data in tick_data.items():
+            if not obj_data:
+                continue
+            object_type = obj_data.get('type')
+            if object_type == 'creep' and creep_id not in creeps_found:
+                owner = obj_data['user']
+                # User ID 2 is invader, user ID 3 is source keeper.
+                if not (owner.isdigit() and (int(owner) == 2 or int(owner) == 3)):
+                    user_ids.add(owner)
+            elif need_owner and object_type == 'controller':
+                if obj_data.get('user') is not None:
+                    user_ids.add(obj_data['user'])
+                elif obj_data.get('reservation') is not None:
+                    user_ids.add(obj_data['reservation']['user'])
+    return user_ids
 
 
 def modify_data_with_history(battle_data, history_result, checking=None):
@@ -223,6 +425,8 @@ def modify_data_with_history(battle_data, history_result, checking=None):
                battle, this will return False
              If checking is None, this returns None.
     """
+    # Usernames are all fetched at once up front, rather than one at a time as new creeps are found.
+    usernames = user_info.usernames_from_ids(_find_user_ids_to_resolve(battle_data, history_result))
     earliest_tick = None
     latest_tick = None
     earliest_hostilities_this_section = None
@@ -244,30 +448,23 @@ def modify_data_with_history(battle_data, history_result, checking=None):
             if not obj_data:
                 continue
             if obj_data.get('type') == 'creep' and creep_id not in battle_data['creeps_found']:
-                battle_data['creeps_found'].append(creep_id)
+                battle_data['creeps_found'].add(creep_id)
                 owner = obj_data['user']
                 # User ID 2 is invader, user ID 3 is source keeper.
                 if owner.isdigit() and (int(owner) == 2 or int(owner) == 3):
                     continue
-                # TODO: maybe fetch usernames from IDs all at once later on, to ensure consistency if any user changes
-                # their username while we're still scanning history?
-                # Probably not too important anyways though, as our username cache lasts 5 hours.
-                owner_dict = battle_data['player_creep_counts'].setdefault(user_info.username_from_id(owner), {})
+                owner_dict = battle_data['player_creep_counts'].setdefault(usernames[owner], {})
                 creep_type = identify_creep(obj_data)
                 owner_dict[creep_type] = owner_dict.get(creep_type, 0) + 1
             if battle_data['owner'] is None and obj_data.get('type') == 'controller':
                 if obj_data.get('user') is not None:
-                    battle_data['owner'] = user_info.username_from_id(obj_data.get('user'))
+                    battle_data['owner'] = usernames[obj_data.get('user')]
                     battle_data['rcl'] = obj_data.get('level')
                 elif obj_data.get('reservation') is not None:
-                    battle_data['owner'] = user_info.username_from_id(obj_data['reservation']['user'])
+                    battle_data['owner'] = usernames[obj_data['reservation']['user']]
                     battle_data['rcl'] = 0
-            if bother_finding_hostilities and not hostilities_this_tick:
-                action_log = obj_data.get('actionLog')
-                if action_log and (action_log.get('attack') or action_log.get('rangedAttack')
-                                   or action_log.get('rangedMassAttack')
-                                   or action_log.get('heal') or action_log.get('rangedHeal')):
-                    hostilities_this_tick = True
+            if bother_finding_hostilities and not hostilities_this_tick and _is_hostile_action(obj_data):
+                hostilities_this_tick = True
 
         if hostilities_this_tick:
             if earliest_hostilities_this_section is None or tick < earliest_hostilities_this_section:
@@ -303,9 +500,75 @@ def modify_data_with_history(battle_data, history_result, checking=None):
     return return_value
 
 
+def _is_hostile_action(obj_data):
+    """
+    Checks whether an object's data in a history tick shows it attacking or healing.
+    """
+    action_log = obj_data.get('actionLog')
+    return bool(action_log and (action_log.get('attack') or action_log.get('rangedAttack')
+                                or action_log.get('rangedMassAttack')
+                                or action_log.get('heal') or action_log.get('rangedHeal')))
+
+
+def _is_peaceful_section(history_result):
+    """
+    Checks whether a history result has at least one tick, and no hostile actions in any of its ticks.
+    """
+    if not history_result['ticks']:
+        return False
+    return not any(obj_data and _is_hostile_action(obj_data)
+                   for tick_data in history_result['ticks'].values()
+                   for obj_data in tick_data.values())
+
+
+# Every body part type in the game, in the order used for body signature bits.
+_BODY_PART_TYPES = ('move', 'work', 'carry', 'attack', 'ranged_attack', 'heal', 'claim', 'tough')
+_BODY_PART_BITS = {part_type: 1 << index for index, part_type in enumerate(_BODY_PART_TYPES)}
+# Set in a body signature when a body has more than 8 work parts (see _identify_creep_body).
+_MANY_WORK_PARTS_BIT = 1 << len(_BODY_PART_TYPES)
+
+# Creep roles by body signature. Signatures are 9 bits, so this never has more than 512 entries.
+_roles_by_body_signature = {}
+
+
+def _body_signature(body):
+    """
+    Reduces a body to the only things _identify_creep_body depends on for bodies made of known part types: which part
+    types it has, and whether it has more than 8 work parts.
+    :return: The signature, or None if the body has parts of unknown types.
+    :rtype: int | None
+    """
+    signature = 0
+    work_parts = 0
+    for part in body:
+        bit = _BODY_PART_BITS.get(part.get('type'))
+        if bit is None:
+            return None
+        signature |= bit
+        if part['type'] == 'work':
+            work_parts += 1
+    if work_parts > 8:
+        signature |= _MANY_WORK_PARTS_BIT
+    return signature
+
+
 def identify_creep(creep_obj):
+    """
+    Gets the role of a creep, based on its body.
+
+    Armies tend to be made of many creeps sharing a few different bodies, so roles are remembered by body signature.
+    """
     body = creep_obj['body']
+    signature = _body_signature(body)
+    if signature is None:
+        return _identify_creep_body(body)
+    role = _roles_by_body_signature.get(signature)
+    if role is None:
+        role = _roles_by_body_signature.setdefault(signature, _identify_creep_body(body))
+    return role
+
 
+def _identify_creep_body(body):
     def has(type):
         return any(x.get('type') == type for x in body)
 
@@ -342,31 +605,178 @@ def identify_creep(creep_obj):
         return ''.join(x['type'][0].upper() for x in body)
 
 
-def process_all_pending_battles_once():
+def _get_latest_tick():
     """
-    Loops through and checks all pending battles once.
+    Gets the latest tick retrieved from the battles API, or 0 if none has been retrieved yet.
+    :rtype: int
+    """
+    latest_tick = redis_data.get_latest_fetched_tick()
+    if latest_tick:
+        return int(latest_tick.decode())
+    else:
+        return 0
+
+
+def _get_current_tick():
+    """
+    Gets the estimated current game tick, from the tick clock. The battles API is only polled every few minutes, so the
+    last tick it returned is only used if the game tick can't be fetched.
+    :rtype: int
+    """
+    try:
+        return screeps.get_time()
+    except (ScreepsError, NewConnectionError, RequestException, ValueError, KeyError):
+        logger.exception("Error getting the game tick, using the latest tick from the battles API instead.")
+        return _get_latest_tick()
+
+
+def _process_and_submit_room(room_name, current_tick):
+    """
+    Processes a room once, submitting it to the reporting queue if the battle is finished.
+    :return: None if the battle was submitted, otherwise the earliest game tick at which processing the room again could
+             make progress.
+    """
+    battle_data, next_tick_needed = _process_room(room_name, current_tick)
+
+    if battle_data is None:
+        return history_cache.get_earliest_request_tick(room_name, next_tick_needed)
+
+    logger.debug("Processed {}: submitting to reporting queue!".format(room_name))
+
+    # If our lease was lost, another worker has the room now and will submit it instead.
+    redis_queue.submit_processed_battle(room_name, battle_data, redis_queue.get_worker_token())
+    return None
+
+
+class _LeaseHeartbeat(object):
+    """
+    Renews the leases on every room this process has claimed, from a background thread, for as long as it's entered.
+
+    Also remembers when each claimed room should next be processed, for releasing the rooms at the end of the pass.
+    """
+
+    def __init__(self, default_due_tick):
+        # Room name to due tick, for every room still held.
+        self._rooms = {}
+        self._default_due_tick = default_due_tick
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def rooms(self):
+        with self._lock:
+            return set(self._rooms)
+
+    @property
+    def due_ticks(self):
+        with self._lock:
+            return dict(self._rooms)
+
+    def add(self, room_name):
+        with self._lock:
+            self._rooms[room_name] = self._default_due_tick
+
+    def set_due_tick(self, room_name, due_tick):
+        with self._lock:
+            if room_name in self._rooms:
+                self._rooms[room_name] = due_tick
+
+    def discard(self, room_name):
+        with self._lock:
+            self._rooms.pop(room_name, None)
+
+    def _run(self):
+        interval = app.config['PROCESSING_LEASE_SECONDS'] / 3
+        with app.app_context():
+            while not self._stop_event.wait(interval):
+                rooms = self.rooms
+                try:
+                    held = redis_queue.renew_room_leases(rooms)
+                except Exception:
+                    logger.exception("Error renewing room leases.")
+                    continue
+                lost = rooms - held
+                if lost:
+                    logger.warning("Lost leases on rooms {}.".format(", ".join(sorted(lost))))
+                    for room_name in lost:
+                        self.discard(room_name)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop_event.set()
+        self._thread.join()
+
+
+def _process_claimed_rooms(heartbeat):
+    """
+    Claims and processes rooms until no more rooms are due.
+
+    The game tick is estimated again for each claim, so that rooms which become due part way through a pass are still
+    processed in it.
+
+    Rooms which aren't finished stay claimed (and out of the schedule) until the end of the pass, so that each room is
+    only processed once per pass.
     """
-    first_room = None
     while True:
-        room_name = redis_queue.get_next_room_to_process(blocking=False)
+        current_tick = _get_current_tick()
+        room_name = redis_queue.claim_room_to_process(current_tick)
         if room_name is None:
-            break
-        elif room_name == first_room:
-            break  # We've completely cycled through the queue once.
-
-        latest_tick = redis_data.get_latest_fetched_tick()
-        if latest_tick:
-            latest_tick = int(latest_tick.decode())
+            return
+        heartbeat.add(room_name)
+        try:
+            due_tick = _process_and_submit_room(room_name, current_tick)
+        except Exception:
+            # Leave the room to be retried next pass, and keep processing other rooms.
+            logger.exception("Error processing room {}".format(room_name))
+            continue
+        if due_tick is None:
+            heartbeat.discard(room_name)
         else:
-            latest_tick = 0
+            heartbeat.set_due_tick(room_name, due_tick)
 
-        battle_data = process_room(room_name, latest_tick)
 
-        if battle_data is None:
-            if first_room is None:
-                first_room = room_name  # Mark our position in the queue so that we only loop through it once.
-            continue
+def _process_claimed_rooms_in_context(heartbeat):
+    """
+    Same as _process_claimed_rooms, but pushes an app context first so that it can be run from a worker thread.
+    """
+    with app.app_context():
+        _process_claimed_rooms(heartbeat)
+
+
+def process_all_pending_battles_once(workers=None):
+    """
+    Loops through and checks all pending battles once.
 
-        logger.debug("Processed {}: submitting to reporting queue!".format(room_name))
+    Only rooms which are due are processed: after each check, a room is scheduled for the earliest tick at which the
+    next history segment it needs could exist, and is claimed once the estimated game tick (see _get_current_tick)
+    reaches that. Rooms are claimed with a lease, so any number of processes (on any number of hosts) can run this at
+    the same time without processing the same room twice.
 
-        redis_queue.submit_processed_battle(room_name, battle_data)
+    :param workers: The number of rooms to process at once. Defaults to the PROCESSING_WORKERS setting. With more than
+                    one worker, rooms are processed concurrently in a thread pool.
+    """
+    if workers is None:
+        workers = app.config['PROCESSING_WORKERS']
+    redis_queue.migrate_legacy_queues()
+    # Rooms which fail to process are retried next pass.
+    with _LeaseHeartbeat(_get_current_tick()) as heartbeat:
+        try:
+            if workers > 1:
+                logger.debug("Processing rooms with {} workers.".format(workers))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    futures = [executor.submit(_process_claimed_rooms_in_context, heartbeat)
+                               for _ in range(workers)]
+                    for future in futures:
+                        future.result()
+            else:
+                _process_claimed_rooms(heartbeat)
+        finally:
+            # Everything still held needs more processing later.
+            due_ticks = heartbeat.due_ticks
+            redis_queue.release_rooms(due_ticks)
+            logger.debug("{} rooms rescheduled.".format(len(due_ticks)))
@@ -1,53 +1,122 @@
-from leaguebot.services.cache import cache
-import requests
+import re
+import sys
+import threading
+import time
 
-room_url = 'http://www.leagueofautomatednations.com/map/rooms.js'
-alliances_url = 'http://www.leagueofautomatednations.com/alliances.js'
+from leaguebot import app
+from leaguebot.models import alliances
+from leaguebot.services import http_client
 
+room_url = app.config['LOAN_URL'] + 'map/rooms.js'
 
-def getRoomOwner(room):
-    room_data = getRoomData()
-    if room not in room_data:
-        return False
-    if 'owner' not in room_data[room]:
-        return False
-    return room_data[room]['owner']
+# Seconds between checks for a new rooms snapshot.
+app.config.setdefault('ROOM_INDEX_REFRESH_SECONDS', 60)
 
+logger = app.logger
 
-def getRoomLevel(room):
-    room_data = getRoomData()
-    if room not in room_data:
-        return False
-    if 'level' not in room_data[room]:
-        return False
-    return room_data[room]['level']
+_room_name_pattern = re.compile(r'^([WE])(\d+)([NS])(\d+)$')
 
 
-def getUserAlliance(username):
-    userlist = getAllianceUserData()
-    if username in userlist:
-        return userlist[username]
-    return False
+def _room_key(room):
+    """
+    Packs a room name into a single int from its coordinates, W0N0 being (-1, -1) and E0S0 (0, 0).
+    :return: The packed coordinates, or the name itself if it isn't a valid room name.
+    """
+    match = _room_name_pattern.match(room)
+    if match is None:
+        return room
+    horizontal, x, vertical, y = match.groups()
+    x = -int(x) - 1 if horizontal == 'W' else int(x)
+    y = -int(y) - 1 if vertical == 'N' else int(y)
+    return ((x + 32768) << 16) | (y + 32768)
+
+
+class RoomIndex(object):
+    """
+    Owners and levels of rooms from one rooms.js snapshot, keyed by packed room coordinates.
+    """
+
+    def __init__(self, room_data):
+        # Most rooms are owned by a player who owns many others, so each owner name is only stored once.
+        self.owners = {}
+        self.levels = {}
+        for room, info in room_data.items():
+            key = _room_key(room)
+            if 'owner' in info:
+                owner = info['owner']
+                self.owners[key] = sys.intern(owner) if isinstance(owner, str) else owner
+            if 'level' in info:
+                self.levels[key] = info['level']
+
+    def get_owner(self, room):
+        return self.owners.get(_room_key(room), False)
+
+    def get_level(self, room):
+        return self.levels.get(_room_key(room), False)
 
 
-@cache.cache(expire=60)
-def getRoomData():
-    r = requests.get(room_url)
-    return r.json()
+_room_index = None
+_room_index_checked_at = None
+_room_index_validators = {}
+_room_index_lock = threading.Lock()
 
 
-@cache.cache(expire=60)
-def getAllianceData():
-    r = requests.get(alliances_url)
-    return r.json()
+def _refresh_room_index():
+    """
+    Fetches rooms.js if it has changed since it was last fetched, and rebuilds the room index from it.
+    """
+    global _room_index, _room_index_validators
+    headers = {}
+    if _room_index is not None:
+        if 'etag' in _room_index_validators:
+            headers['If-None-Match'] = _room_index_validators['etag']
+        if 'last-modified' in _room_index_validators:
+            headers['If-Modified-Since'] = _room_index_validators['last-modified']
+    r = http_client.get(room_url, headers=headers)
+    if r.status_code == 304 and _room_index is not None:
+        return
+    r.raise_for_status()
+    _room_index = RoomIndex(r.json())
+    _room_index_validators = {name: r.headers[name] for name in ('etag', 'last-modified') if name in r.headers}
 
 
-@cache.cache(expire=60)
-def getAllianceUserData():
-    alliances = getAllianceData()
-    users = {}
-    for alliance in alliances:
-        alliance_name = alliances[alliance]['name']
-        for member in alliances[alliance]['members']:
-            users[member] = alliance_name
-    return users
+def get_room_index():
+    """
+    Gets the index of rooms, checking for a new snapshot at most every ROOM_INDEX_REFRESH_SECONDS.
+
+    If a snapshot can't be fetched, the last one is kept until the next check.
+    :rtype: RoomIndex
+    """
+    global _room_index_checked_at
+    now = time.monotonic()
+    refresh_seconds = app.config['ROOM_INDEX_REFRESH_SECONDS']
+    # Only set once there's an index, so this can be checked without the lock.
+    checked_at = _room_index_checked_at
+    if checked_at is not None and now - checked_at < refresh_seconds:
+        return _room_index
+    with _room_index_lock:
+        if _room_index_checked_at is None or now - _room_index_checked_at >= refresh_seconds:
+            try:
+                _refresh_room_index()
+            except Exception:
+                if _room_index is None:
+                    raise
+                logger.exception("Failed to refresh rooms, using the last snapshot.")
+            _room_index_checked_at = now
+        return _room_index
+
+
+def getRoomOwner(room):
+    return get_room_index().get_owner(room)
+
+
+def getRoomLevel(room):
+    return get_room_index().get_level(room)
+
+
+def getUserAlliance(username):
+    index = alliances.get_alliance_index()
+    abbreviation = index.get_alliance(username)
+    if abbreviation is None:
+        return False
+    return index.get_alliance_name(abbreviation)
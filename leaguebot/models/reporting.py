@@ -1,10 +1,25 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import leaguebot.services.alerters.cli
 import leaguebot.services.alerters.slack
 import leaguebot.services.alerters.twitter
 from leaguebot import app
 from leaguebot.services import redis_queue
+from leaguebot.services.ratelimit import TokenBucket
 from leaguebot.static_constants import civilian, scout, SLACK_QUEUE, TWITTER_QUEUE
 
+# Messages sent per second to each sink, and the most sent in a burst.
+app.config.setdefault('SLACK_MESSAGES_PER_SECOND', 1)
+app.config.setdefault('SLACK_MESSAGE_BURST', 4)
+app.config.setdefault('TWITTER_MESSAGES_PER_SECOND', 1 / 36)
+app.config.setdefault('TWITTER_MESSAGE_BURST', 5)
+# The longest to wait for a sink's rate limit before leaving the rest of its messages for the next pass, in seconds.
+app.config.setdefault('MESSAGE_RATE_LIMIT_MAX_WAIT', 10)
+# Number of times a failed message is retried within one pass, and the exponential backoff factor between tries.
+app.config.setdefault('MESSAGE_SEND_RETRIES', 2)
+app.config.setdefault('MESSAGE_RETRY_BACKOFF', 1.0)
+
 
 def should_report(battle_info):
     # Don't report a single player dismantling their own things
@@ -30,6 +45,7 @@ def report_pending_battles():
     """
     Tries to reports all pending battles once.
     """
+    redis_queue.migrate_legacy_queues()
     while True:
         result_tuple = redis_queue.get_next_battle_to_report(blocking=False)
         if result_tuple is None:
@@ -58,32 +74,82 @@ def report_pending_battles():
         )
 
 
+def _get_rate_limiter(queue):
+    """
+    Gets the rate limiter for a sink. Its state is kept in redis, so limits hold across cron runs and worker processes.
+    :rtype: TokenBucket
+    """
+    if queue == SLACK_QUEUE:
+        rate, capacity = app.config['SLACK_MESSAGES_PER_SECOND'], app.config['SLACK_MESSAGE_BURST']
+    else:
+        rate, capacity = app.config['TWITTER_MESSAGES_PER_SECOND'], app.config['TWITTER_MESSAGE_BURST']
+    return TokenBucket(queue + ":rate-limit", rate, capacity)
+
+
+def _send_with_retries(send, message):
+    """
+    :return: True if the message was sent.
+    """
+    retries = app.config['MESSAGE_SEND_RETRIES']
+    for attempt in range(retries + 1):
+        if send(message):
+            return True
+        if attempt < retries:
+            time.sleep(app.config['MESSAGE_RETRY_BACKOFF'] * 2 ** attempt)
+    return False
+
+
+def _send_queued_messages(queue, send):
+    """
+    Sends every message in a queue once, within the sink's rate limit.
+
+    Each message is locked while it's being sent, and only removed from the queue once it's sent, so it's sent exactly
+    once even with several processes sending at the same time. Messages which can't be sent stay locked until the end
+    of the pass, so each is only tried once per pass, and are then released to be tried again next time.
+    """
+    limiter = _get_rate_limiter(queue)
+    failed = []  # Also includes a message pulled just before running into the rate limit.
+    try:
+        while True:
+            pulled = redis_queue.pull_reportable_message(queue)
+            if pulled is None:
+                break
+            message_id, message = pulled
+            if not limiter.acquire(timeout=app.config['MESSAGE_RATE_LIMIT_MAX_WAIT']):
+                logger.info("Rate limited sending to {}, leaving the rest for later.".format(queue))
+                failed.append(message_id)
+                break
+            if _send_with_retries(send, message):
+                redis_queue.finish_reportable_message(queue, message_id)
+            else:
+                logger.warning("Couldn't send message to {}, leaving it for later: {}".format(queue, message))
+                failed.append(message_id)
+    finally:
+        for message_id in failed:
+            redis_queue.release_reportable_message(queue, message_id)
+
+
 def send_slack_messages():
     redis_queue.merge_slack_queue()
-    first_failure = None  # for making sure we don't loop forever.
-    while True:
-        message = redis_queue.pull_reportable_message(SLACK_QUEUE)
-        if message is None or message == first_failure:
-            break
-
-        success = leaguebot.services.alerters.slack.sendToSlack(message)
-        if success:
-            redis_queue.finish_reportable_message(SLACK_QUEUE, message)
-        else:
-            if first_failure is None:
-                first_failure = message
+    _send_queued_messages(SLACK_QUEUE, leaguebot.services.alerters.slack.sendToSlack)
 
 
 def send_twitter_messages():
-    first_failure = None  # for making sure we don't loop forever.
-    while True:
-        message = redis_queue.pull_reportable_message(TWITTER_QUEUE)
-        if message is None or message == first_failure:
-            break
+    _send_queued_messages(TWITTER_QUEUE, leaguebot.services.alerters.twitter.sendToTwitter)
 
-        success = leaguebot.services.alerters.twitter.sendToTwitter(message)
-        if success:
-            redis_queue.finish_reportable_message(TWITTER_QUEUE, message)
-        else:
-            if first_failure is None:
-                first_failure = message
+
+def _send_in_context(send_messages):
+    with app.app_context():
+        send_messages()
+
+
+def send_pending_messages():
+    """
+    Sends all queued Slack and Twitter messages, with each sink sending at the same time, so that one slow or rate
+    limited sink doesn't hold up the other.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(_send_in_context, send_messages)
+                   for send_messages in (send_slack_messages, send_twitter_messages)]
+        for future in futures:
+            future.result()
@@ -1,60 +1,125 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from requests.packages.urllib3.exceptions import NewConnectionError
+from leaguebot import app
+from leaguebot.models import alliances
+from leaguebot.services import http_client, redis_data
+from leaguebot.services.lru import LRUCache
+from leaguebot.static_constants import ScreepsError, USERNAME_CACHE_EXPIRE
 
-from leaguebot.services import redis_data
-from leaguebot.static_constants import ScreepsError
-
-_URL_ROOT = "https://screeps.com/"
+_URL_ROOT = app.config['SCREEPS_URL']
 
 USERNAME_URL_FORMAT = _URL_ROOT + "api/user/find"
 
-ALLIANCES_URL = "http://www.leagueofautomatednations.com/alliances.js"
-
 logger = logging.getLogger("warreport")
 
+# Number of usernames remembered in each process, in front of the redis username cache.
+app.config.setdefault('USERNAME_LRU_SIZE', 10000)
+# Maximum number of usernames fetched from the API at once.
+app.config.setdefault('USERNAME_FETCH_WORKERS', 8)
 
-def username_from_id(user_id):
-    cached = redis_data.get_username(user_id)
-    if cached is not None:
-        return cached
-    call_result = requests.get(USERNAME_URL_FORMAT, params={'id': user_id})
+_username_lru = LRUCache(app.config['USERNAME_LRU_SIZE'], ttl=USERNAME_CACHE_EXPIRE)
+
+# Futures for usernames currently being fetched, by user ID, so that each username is only fetched once at a time.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+_fetch_executor = None
+
+
+def _fetch_username(user_id):
+    """
+    Fetches a single username from the API, without any caching.
+    :raises ScreepsError: if the username can't be found.
+    """
+    call_result = http_client.get(USERNAME_URL_FORMAT, params={'id': user_id})
     if call_result.ok:
         name = call_result.json().get('user', {}).get('username', None)
         if name is None:
             raise ScreepsError("{} ({}, at {})".format(call_result.text, call_result.status_code, call_result.url))
-        redis_data.set_username(user_id, name)
         return name
     else:
         raise ScreepsError("{} ({}, at {})".format(call_result.text, call_result.status_code,
                                                    call_result.url))
 
 
-def _update_alliance_data():
+def _get_fetch_executor():
+    global _fetch_executor
+    if _fetch_executor is None:
+        with _in_flight_lock:
+            if _fetch_executor is None:
+                _fetch_executor = ThreadPoolExecutor(max_workers=app.config['USERNAME_FETCH_WORKERS'])
+    return _fetch_executor
+
+
+def _fetch_usernames(user_ids):
+    """
+    Fetches many usernames from the API at once.
+
+    If another thread is already fetching one of the usernames, that fetch is waited on rather than starting another.
+    :return: A tuple of (usernames_by_id, fetched_by_us), where fetched_by_us is a dict of only the usernames which this
+             call fetched itself (rather than waiting on another thread for).
+    :raises ScreepsError: if any of the usernames can't be found.
+    """
+    executor = _get_fetch_executor()
+    futures = {}
+    started = set()
+    with _in_flight_lock:
+        for user_id in user_ids:
+            future = _in_flight.get(user_id)
+            if future is None:
+                future = executor.submit(_fetch_username, user_id)
+                _in_flight[user_id] = future
+                started.add(user_id)
+            futures[user_id] = future
     try:
-        result = requests.get(ALLIANCES_URL)
-    except NewConnectionError:
-        logger.exception("Error getting {}.".format(ALLIANCES_URL))
-        redis_data.update_alliance_data([])  # try again in 4 hours.
-        return
-    json_root = result.json()
-    if json_root is None:
-        logger.error("Error parsing alliance data as json. {} ({}, at {})"
-                     .format(result.text, result.status_code, result.url))
-        redis_data.update_alliance_data([])
-        return
-
-    user_alliance_tuple_list = []
-    for alliance_abbrev, alliance_data in json_root.items():
-        for member in alliance_data['members']:
-            # TODO: do we want to use the full alliance name, or the abbreviation?
-            user_alliance_tuple_list.append((member, alliance_abbrev))
-    redis_data.update_alliance_data(user_alliance_tuple_list)
+        usernames = {user_id: future.result() for user_id, future in futures.items()}
+    finally:
+        with _in_flight_lock:
+            for user_id in started:
+                del _in_flight[user_id]
+    _username_lru.set_many(usernames)
+    return usernames, {user_id: usernames[user_id] for user_id in started}
+
+
+def usernames_from_ids(user_ids):
+    """
+    Gets the usernames for many user IDs at once.
+
+    Usernames are looked up in a process-local cache first, then in redis with a single query, and any which are still
+    missing are fetched from the API concurrently.
+    :return: A dict of user_id to username.
+    :rtype: dict[str, str]
+    :raises ScreepsError: if any of the usernames can't be found.
+    """
+    user_ids = set(user_ids)
+    usernames = _username_lru.get_many(user_ids)
+    missing = [user_id for user_id in user_ids if user_id not in usernames]
+    if missing:
+        cached = redis_data.get_usernames(missing)
+        _username_lru.set_many(cached)
+        usernames.update(cached)
+        missing = [user_id for user_id in missing if user_id not in cached]
+    if missing:
+        fetched, fetched_by_us = _fetch_usernames(missing)
+        redis_data.set_usernames(fetched_by_us)
+        usernames.update(fetched)
+    return usernames
+
+
+def username_from_id(user_id):
+    return usernames_from_ids([user_id])[user_id]
+
+
+def alliances_from_usernames(usernames):
+    """
+    Gets the alliances of many users at once.
+    :return: A dict of username to alliance abbreviation, with None for users who aren't in an alliance.
+    :rtype: dict[str, str | None]
+    """
+    index = alliances.get_alliance_index()
+    return {username: index.get_alliance(username) for username in usernames}
 
 
 def alliance_from_username(username):
-    # TODO: write storage methods to abstract out these database calls!
-    if not redis_data.is_alliance_data_recent():
-        _update_alliance_data()
-    return redis_data.get_cached_alliance(username)
+    return alliances_from_usernames([username])[username]
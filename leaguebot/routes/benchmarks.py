@@ -0,0 +1,264 @@
+"""
+Command line benchmarks for the performance-sensitive parts of history processing.
+
+These don't need any external services unless stated otherwise: run them with `flask <command_name> --help`.
+"""
+import json
+import random
+import time
+import tracemalloc
+
+import click
+import redis
+from flask import g
+
+from leaguebot import app
+from leaguebot.models import history
+from leaguebot.services import history_parser, redis_queue
+from leaguebot.static_constants import PROCESSING_QUEUE_SET, PROCESSING_SCHEDULE, BATTLE_DATA_KEY, BATTLE_CREEPS_KEY, \
+    BATTLE_DATA_EXPIRE, KEEP_IN_QUEUE_FOR_MAX_TICKS, LAST_CHECKED_TICK_KEY, LAST_CHECKED_TICK_EXPIRE
+
+_BODY_PART_TYPES = ('move', 'work', 'carry', 'attack', 'ranged_attack', 'heal', 'claim', 'tough')
+
+
+def _time_best_of(repeats, func, *args):
+    """
+    :return: The fastest run time of func, in seconds.
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(*args)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _peak_memory(func, *args):
+    """
+    :return: The peak memory allocated while running func, in bytes.
+    """
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _synthetic_object_id(rng):
+    return '{:024x}'.format(rng.getrandbits(96))
+
+
+def _synthetic_history_segment(object_count, seed=0):
+    """
+    Creates a history segment shaped like the ones screeps.com serves for a room in the middle of a battle: full objects
+    for the first tick, followed by 19 ticks of creeps moving, attacking and healing.
+    :return: The raw segment content.
+    :rtype: bytes
+    """
+    rng = random.Random(seed)
+    base_tick = 1000000
+    first_tick = {}
+    creep_ids = []
+    for index in range(object_count):
+        object_id = _synthetic_object_id(rng)
+        common = {
+            '_id': object_id,
+            'room': 'W0N0',
+            'x': rng.randint(1, 48),
+            'y': rng.randint(1, 48),
+            'hits': rng.randint(1, 5000),
+            'hitsMax': 5000,
+            'notifyWhenAttacked': True,
+        }
+        if index % 4 == 0:
+            creep_ids.append(object_id)
+            common.update({
+                'type': 'creep',
+                'name': 'creep{}'.format(index),
+                'user': str(rng.randint(10, 12)),
+                'body': [{'type': rng.choice(_BODY_PART_TYPES), 'hits': 100, 'boost': None} for _ in range(50)],
+                'energy': 0,
+                'energyCapacity': 0,
+                'spawning': False,
+                'fatigue': 0,
+                'ageTime': base_tick + 1500,
+                'actionLog': {action: None for action in ('attacked', 'healed', 'attack', 'rangedAttack',
+                                                          'rangedMassAttack', 'rangedHeal', 'harvest', 'heal',
+                                                          'repair', 'build', 'say', 'upgradeController',
+                                                          'reserveController')},
+            })
+        elif index == 1:
+            common.update({'type': 'controller', 'user': '10', 'level': 8, 'progress': 0, 'downgradeTime': None,
+                           'safeMode': None, 'safeModeAvailable': 3, 'reservation': None})
+        else:
+            common.update({'type': rng.choice(('extension', 'rampart', 'constructedWall', 'road', 'tower')),
+                           'user': '10', 'energy': 50, 'energyCapacity': 50, 'off': False})
+        first_tick[object_id] = common
+    ticks = {str(base_tick): first_tick}
+    for tick in range(base_tick + 1, base_tick + 20):
+        updates = {}
+        for creep_id in creep_ids:
+            updates[creep_id] = {
+                'x': rng.randint(1, 48),
+                'y': rng.randint(1, 48),
+                'actionLog': {'attack': {'x': 25, 'y': 25}} if rng.random() < 0.3 else {'attack': None},
+            }
+        ticks[str(tick)] = updates
+    return json.dumps({'timestamp': 1479000000000, 'room': 'W0N0', 'base': base_tick, 'ticks': ticks}).encode()
+
+
+@app.cli.command()
+@click.option('--objects', default=2000, help="Number of room objects in the generated segment.")
+@click.option('--repeats', default=5, help="Number of times to time each parse (the fastest is reported).")
+@click.argument('segment_files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+def benchmark_history_parsing(objects, repeats, segment_files):
+    """
+    Compares full and selective history parsing with each JSON backend.
+
+    Uses the given room history files (as downloaded from room-history/{room}/{tick}.json), or a generated segment if
+    none are given.
+    """
+    if segment_files:
+        segments = []
+        for path in segment_files:
+            with open(path, 'rb') as f:
+                segments.append((path, f.read()))
+    else:
+        segments = [('generated ({} objects)'.format(objects), _synthetic_history_segment(objects))]
+
+    for name, content in segments:
+        click.echo("{}: {:,} bytes".format(name, len(content)))
+        for backend in history_parser.get_backend_names():
+            for selective in (False, True):
+                duration = _time_best_of(repeats, history_parser.parse_history, content, selective, backend)
+                peak = _peak_memory(history_parser.parse_history, content, selective, backend)
+                click.echo("    {:<10} {:<10} {:8.1f} ms  {:10,} bytes peak".format(
+                    backend, 'selective' if selective else 'full', duration * 1000, peak))
+
+
+def _synthetic_creep_bodies(creep_count, template_count, seed=0):
+    """
+    Creates creeps the way real armies look: a few body templates, each used by many creeps, with parts in a random
+    order.
+    """
+    rng = random.Random(seed)
+    templates = []
+    for _ in range(template_count):
+        size = rng.randint(1, 50)
+        templates.append([rng.choice(_BODY_PART_TYPES) for _ in range(size)])
+    creeps = []
+    for _ in range(creep_count):
+        body = [{'type': part_type, 'hits': 100} for part_type in rng.choice(templates)]
+        rng.shuffle(body)
+        creeps.append({'type': 'creep', 'body': body})
+    return creeps
+
+
+@app.cli.command()
+@click.option('--creeps', default=5000, help="Number of creeps to identify.")
+@click.option('--templates', default=12, help="Number of different bodies used by the creeps.")
+@click.option('--repeats', default=5, help="Number of times to time each method (the fastest is reported).")
+def benchmark_identify_creep(creeps, templates, repeats):
+    """
+    Compares identifying creeps by body signature against checking each body in full.
+    """
+    creep_objs = _synthetic_creep_bodies(creeps, templates)
+
+    def identify_full():
+        return [history._identify_creep_body(creep['body']) for creep in creep_objs]
+
+    def identify_by_signature():
+        history._roles_by_body_signature.clear()
+        return [history.identify_creep(creep) for creep in creep_objs]
+
+    if identify_full() != identify_by_signature():
+        raise click.ClickException("Roles found by signature don't match roles found in full!")
+
+    full_duration = _time_best_of(repeats, identify_full)
+    signature_duration = _time_best_of(repeats, identify_by_signature)
+    click.echo("{:,} creeps, {} bodies:".format(creeps, templates))
+    click.echo("    full       {:8.1f} ms".format(full_duration * 1000))
+    click.echo("    signature  {:8.1f} ms ({} signatures remembered)".format(
+        signature_duration * 1000, len(history._roles_by_body_signature)))
+
+
+# How battles were queued before push_battles_for_processing was batched: one script call per room, in a pipeline.
+_per_room_insert_script = redis.client.Script(None, """
+local added = redis.call('sismember', KEYS[1], ARGV[1])
+if added == 0 then
+    redis.call('sadd', KEYS[1], ARGV[1])
+    redis.call('zadd', KEYS[2], ARGV[4], ARGV[1])
+    redis.call('set', KEYS[3], ARGV[2], 'ex', ARGV[3])
+    redis.call('del', KEYS[4])
+end
+""")
+
+
+def _push_battles_per_room(new_latest_tick, battles_array):
+    redis_conn = g.redis_connection
+    if not _per_room_insert_script.sha or not redis_conn.script_exists(_per_room_insert_script.sha):
+        _per_room_insert_script.sha = redis_conn.script_load(_per_room_insert_script.script)
+    pipe = redis_conn.pipeline()
+    pipe.set(LAST_CHECKED_TICK_KEY, new_latest_tick, ex=LAST_CHECKED_TICK_EXPIRE)
+    for room_name, hostilities_tick in battles_array:
+        segment_tick = hostilities_tick - hostilities_tick % 20
+        _per_room_insert_script(
+            keys=[PROCESSING_QUEUE_SET, PROCESSING_SCHEDULE, BATTLE_DATA_KEY.format(room_name),
+                  BATTLE_CREEPS_KEY.format(room_name)],
+            args=[room_name, json.dumps({
+                'tick_to_check': hostilities_tick,
+                'stop_checking_at': segment_tick + KEEP_IN_QUEUE_FOR_MAX_TICKS,
+            }), BATTLE_DATA_EXPIRE, segment_tick + 20],
+            client=pipe,
+        )
+    pipe.execute()
+
+
+def _benchmark_redis_connection(redis_database):
+    if redis_database == app.config['REDIS_DATABASE']:
+        raise click.ClickException("Use a redis database other than the one LeagueBot uses.")
+    return redis.StrictRedis(
+        host=app.config['REDIS_HOST'],
+        port=app.config['REDIS_PORT'],
+        db=redis_database,
+        password=app.config.get('REDIS_PASSWORD'),
+    )
+
+
+def _clear_queued_battles(redis_conn, battles_array):
+    keys = [PROCESSING_QUEUE_SET, PROCESSING_SCHEDULE, LAST_CHECKED_TICK_KEY]
+    for room_name, _ in battles_array:
+        keys.extend((BATTLE_DATA_KEY.format(room_name), BATTLE_CREEPS_KEY.format(room_name)))
+    redis_conn.delete(*keys)
+
+
+@app.cli.command()
+@click.option('--sizes', default='10,100,1000', help="Comma separated numbers of rooms to queue at once.")
+@click.option('--repeats', default=20, help="Number of times to time each method (the fastest is reported).")
+@click.option('--redis-database', default=15, help="Redis database to use. Must not be the one LeagueBot uses.")
+def benchmark_battle_queueing(sizes, repeats, redis_database):
+    """
+    Compares queueing battles with one script call per room against the batched script.
+
+    Needs a redis server: uses the configured host, but a separate database.
+    """
+    redis_conn = _benchmark_redis_connection(redis_database)
+    g.redis_connection = redis_conn
+
+    for size in (int(size) for size in sizes.split(',')):
+        battles_array = [('BENCH{}'.format(index), 1000000 + index) for index in range(size)]
+
+        def queue_with(push_battles):
+            _clear_queued_battles(redis_conn, battles_array)
+            push_battles(1000000 + size, battles_array)
+
+        per_room_duration = _time_best_of(repeats, queue_with, _push_battles_per_room)
+        batched_duration = _time_best_of(repeats, queue_with, redis_queue.push_battles_for_processing)
+        _clear_queued_battles(redis_conn, battles_array)
+        click.echo("{:,} rooms:".format(size))
+        click.echo("    per room   {:8.2f} ms".format(per_room_duration * 1000))
+        click.echo("    batched    {:8.2f} ms".format(batched_duration * 1000))
+
@@ -1,27 +1,106 @@
+import signal
+
 import click
 
 import leaguebot.models.battles
 import leaguebot.services.alerts as alerts
 from leaguebot import app
 from leaguebot.models import history, battles, reporting
+from leaguebot.services import history_cache, http_client, screeps
+from leaguebot.services.scheduler import Scheduler
+from leaguebot.static_constants import CHECK_BATTLES_ENDPOINT_EVERY_SECONDS
 
 logger = app.logger
 
+# Seconds between each run of each stage, when running with run_daemon.
+app.config.setdefault('DAEMON_NUKES_INTERVAL', 5 * 60)
+app.config.setdefault('DAEMON_BATTLES_INTERVAL', CHECK_BATTLES_ENDPOINT_EVERY_SECONDS)
+app.config.setdefault('DAEMON_HISTORY_INTERVAL', 60)
+app.config.setdefault('DAEMON_REPORTING_INTERVAL', 60)
+app.config.setdefault('DAEMON_FLUSH_INTERVAL', 60)
+app.config.setdefault('DAEMON_STATS_INTERVAL', 60 * 60)
+app.config.setdefault('DAEMON_PRUNE_INTERVAL', 60 * 60)
 
-@app.cli.command()
-def send_slack_alerts():
+
+def _send_nuke_alerts():
     logger.info("Checking nukes.")
     nukes = leaguebot.models.battles.get_nukes()
     if nukes:
-        for nuke in reversed(nukes):
-            alerts.sendNukeMessage(nuke)
+        alerts.sendNukeMessages(reversed(nukes))
+
+
+def _prune_sent_alerts():
+    logger.info("Pruning old sent alerts.")
+    alerts.clean()
+
 
+def _queue_new_battles():
     logger.info("Checking and queueing new battles")
     battles.check_and_queue_battles_once()
+
+
+def _process_pending_battles():
     logger.info("Checking each pending battle once.")
     history.process_all_pending_battles_once()
+
+
+def _report_finished_battles():
     logger.info("Reporting any finished battles.")
     reporting.report_pending_battles()
-    reporting.send_slack_messages()
-    reporting.send_twitter_messages()
+
+
+def _flush_messages():
+    reporting.send_pending_messages()
+
+
+def _log_stats():
+    logger.info("HTTP connections: {requests} requests, {handshakes} handshakes, {reused} reused."
+                .format(**http_client.get_connection_stats()))
+    logger.info("History cache: {hits} hits, {misses} misses, {bytes_read} bytes read, {bytes_written} bytes written, "
+                "{missing_suppressed} requests for missing segments skipped."
+                .format(**history_cache.get_stats()))
+    time_stats = screeps.get_time_stats()
+    if time_stats['rate'] is not None:
+        logger.info("Tick clock: {rate:.3f} ticks per second, {drift:+.2f} ticks drift at last sync, {syncs} syncs for "
+                    "{estimates} estimates.".format(**time_stats))
+
+
+@app.cli.command()
+def send_slack_alerts():
+    _send_nuke_alerts()
+    _queue_new_battles()
+    _process_pending_battles()
+    _report_finished_battles()
+    _flush_messages()
+    _prune_sent_alerts()
+    _log_stats()
     click.echo('success')
+
+
+@app.cli.command()
+def run_daemon():
+    """
+    Runs every stage of send_slack_alerts repeatedly, each on its own interval, until SIGTERM or SIGINT.
+
+    Unlike running send_slack_alerts from cron, connection pools and caches stay warm between runs.
+    """
+    scheduler = Scheduler()
+    scheduler.add_stage('nukes', _send_nuke_alerts, app.config['DAEMON_NUKES_INTERVAL'])
+    scheduler.add_stage('battles', _queue_new_battles, app.config['DAEMON_BATTLES_INTERVAL'])
+    scheduler.add_stage('history', _process_pending_battles, app.config['DAEMON_HISTORY_INTERVAL'])
+    scheduler.add_stage('reporting', _report_finished_battles, app.config['DAEMON_REPORTING_INTERVAL'])
+    scheduler.add_stage('flush', _flush_messages, app.config['DAEMON_FLUSH_INTERVAL'])
+    scheduler.add_stage('prune', _prune_sent_alerts, app.config['DAEMON_PRUNE_INTERVAL'])
+    scheduler.add_stage('stats', _log_stats, app.config['DAEMON_STATS_INTERVAL'])
+
+    def handle_signal(signum, frame):
+        logger.info("Received signal {}, stopping after the current stage.".format(signum))
+        scheduler.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    logger.info("Starting daemon.")
+    scheduler.run()
+    _log_stats()
+    logger.info("Daemon stopped.")
@@ -0,0 +1,57 @@
+"""
+Command line tools for running LeagueBot offline against recorded responses.
+
+To record, set HTTP_RECORD_DIR and run send_slack_alerts (with HISTORY_CACHE_ENABLED=False, so that history segments
+are fetched rather than read from disk). To replay, run serve_fixtures on that directory, and point SCREEPS_URL and
+LOAN_URL at it with the original host as the first path segment, for example:
+
+    SCREEPS_URL='http://127.0.0.1:8080/screeps.com/'
+    LOAN_URL='http://127.0.0.1:8080/www.leagueofautomatednations.com/'
+    MESSAGE_SINK='log'
+
+Only screeps.com and LOAN are replayed. Slack, Twitter and is.gd are real services: with MESSAGE_SINK='log', Slack and
+Twitter messages are logged instead of posted, and links aren't shortened. Outgoing messages are still queued,
+merged and rate limited as usual, so the Twitter rate limit (TWITTER_MESSAGES_PER_SECOND) still paces sending.
+"""
+import signal
+
+import click
+
+from leaguebot import app
+from leaguebot.services.fixtures import FixtureServer
+
+logger = app.logger
+
+
+@app.cli.command()
+@click.argument('fixture_dir', type=click.Path(exists=True, file_okay=False))
+@click.option('--host', default='127.0.0.1', help="Address to listen on.")
+@click.option('--port', default=8080, help="Port to listen on.")
+@click.option('--latency', default=0.0, help="Seconds to wait before each response.")
+@click.option('--jitter', default=0.0, help="Most seconds added to or taken from the latency, at random.")
+@click.option('--not-found-pattern', default=None,
+              help="Regex: only requests with a matching path (/<host>/<path>) get forced 404s.")
+@click.option('--not-found-rate', default=0.0,
+              help="Chance of a 404 for each request (matching --not-found-pattern, if given), even if a response was "
+                   "recorded.")
+@click.option('--seed', default=None, type=int, help="Random seed, for reproducible latency and 404s.")
+def serve_fixtures(fixture_dir, host, port, latency, jitter, not_found_pattern, not_found_rate, seed):
+    """
+    Serves responses recorded in FIXTURE_DIR (see HTTP_RECORD_DIR) as a local stand-in for screeps.com and
+    leagueofautomatednations.com, until SIGTERM or SIGINT.
+    """
+    server = FixtureServer(fixture_dir, host, port, latency, jitter, not_found_pattern, not_found_rate, seed)
+
+    def handle_signal(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    click.echo("Serving {} at {}".format(fixture_dir, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    click.echo("{requests} requests: {replayed} replayed, {not_modified} not modified, {not_found} not recorded, "
+               "{forced_not_found} forced 404s.".format(**server.stats))
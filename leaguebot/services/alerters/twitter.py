@@ -1,8 +1,13 @@
-from pyshorteners import Shortener
+import re
 
 import leaguebot.models.map as screepmap
 from leaguebot import app
-from leaguebot.services import screeps, twitter, battle_description
+from leaguebot.services import screeps, twitter, battle_description, link_shortener
+
+# Longest tweet posted. Longer messages have the text before their last link cut short.
+app.config.setdefault('TWITTER_MAX_MESSAGE_LENGTH', 140)
+
+_LINK_PATTERN = re.compile(r'https?://\S+')
 
 
 def sendBattleMessage(battle_data):
@@ -54,7 +59,9 @@ def sendToTwitter(message):
     if 'SEND_TO_TWITTER' not in app.config or not app.config['SEND_TO_TWITTER']:
         return True
     try:
-        message += ' #screeps_battles'
+        # Links are only shortened now, rather than when the message is rendered, see link_shortener. The length is
+        # checked after that, so that it counts the short links.
+        message = fitToLength(link_shortener.shorten_links(message), ' #screeps_battles')
         twitter.send_twitter_message(message)
         app.logger.info("Sent twitter message: {}".format(message))
         return True
@@ -62,21 +69,34 @@ def sendToTwitter(message):
         return False
 
 
+def fitToLength(message, suffix):
+    """
+    Appends suffix to a message, cutting the text before the message's last link short if needed to keep it within
+    TWITTER_MAX_MESSAGE_LENGTH. The link and anything after it are kept whole.
+    """
+    max_length = app.config['TWITTER_MAX_MESSAGE_LENGTH']
+    if len(message) + len(suffix) <= max_length:
+        return message + suffix
+    links = list(_LINK_PATTERN.finditer(message))
+    if links:
+        text, tail = message[:links[-1].start()], message[links[-1].start():]
+    else:
+        text, tail = message, ''
+    # Room for the text, an ellipsis, and the space before the link.
+    text_length = max_length - len(tail) - len(suffix) - (2 if tail else 1)
+    if text_length <= 0:
+        return (message + suffix)[:max_length]
+    return text[:text_length].rstrip() + '\u2026' + (' ' if tail else '') + tail + suffix
+
+
 def getRoomLink(roomname):
-    baseurl = 'https://screeps.com/a/#!/room/' + roomname
-    return getShortenedLink(baseurl)
+    return 'https://screeps.com/a/#!/room/' + roomname
 
 
 def getHistoryLink(roomname, tick):
     tick = str(int(tick)-50)
-    history_link = 'https://screeps.com/a/#!/history/' + roomname + '?t=' + tick
-    return getShortenedLink(history_link)
+    return 'https://screeps.com/a/#!/history/' + roomname + '?t=' + tick
 
 
 def getShortenedLink(baseurl):
-    try:
-        shortener = Shortener('Isgd', timeout=3)
-        url = shortener.short(baseurl)
-    except:
-        url = baseurl
-    return url
+    return link_shortener.shorten(baseurl)
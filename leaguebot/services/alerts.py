@@ -9,20 +9,44 @@ import leaguebot.services.alerters.cli
 
 
 def mark_sent(alert_id):
-    tick = screeps.get_time()
+    mark_all_sent([alert_id])
+
+
+def mark_all_sent(alert_ids, tick=None):
+    """
+    Records alerts as sent, all in one transaction.
+    :param tick: The tick they were sent at. Defaults to the current tick.
+    """
+    if not alert_ids:
+        return
+    if tick is None:
+        tick = screeps.get_time()
     sql = 'REPLACE INTO ALERTS VALUES (?, ?)'
-    db.runQuery(sql, (alert_id, tick))
+    db.execute_many(sql, [(alert_id, tick) for alert_id in alert_ids])
+
+
+def get_recently_sent(alert_ids, limit=50, tick=None):
+    """
+    Checks which of the given alerts have been sent within the last `limit` ticks.
+    :param tick: The current tick. Defaults to fetching it.
+    :return: The set of alert ids which have been sent recently.
+    """
+    alert_ids = list(alert_ids)
+    if not alert_ids:
+        return set()
+    if tick is None:
+        tick = screeps.get_time()
+    tick_limit = tick - limit
+    recently_sent = set()
+    for start in range(0, len(alert_ids), db.MAX_QUERY_PARAMETERS):
+        chunk = alert_ids[start:start + db.MAX_QUERY_PARAMETERS]
+        sql = 'SELECT id FROM ALERTS WHERE tick > ? AND id IN ({})'.format(', '.join('?' * len(chunk)))
+        recently_sent.update(row[0] for row in db.find_all(sql, [tick_limit] + chunk))
+    return recently_sent
 
 
 def should_send(alert_id, limit=50):
-    tick = screeps.get_time()
-    limit = tick - limit
-    sql = 'SELECT tick FROM ALERTS WHERE id = ?'
-    row = db.find_one(sql, (alert_id,))
-    if (row is not None):
-        if row[0] > limit:
-            return False
-    return True
+    return alert_id not in get_recently_sent([alert_id], limit)
 
 
 def clean():
@@ -40,21 +64,36 @@ def sendBattleMessage(battle_data):
 
 
 def sendNukeMessage(nukeinfo):
-    tick = screeps.get_time()
-    eta = nukeinfo['landTime']-tick
-    room_owner = screepmap.getRoomOwner(nukeinfo['room'])
+    return sendNukeMessages([nukeinfo])
 
-    if not room_owner:
-        return False
-
-    if eta < 25:
-        leaguebot.services.alerters.slack.sendNukeMessage(nukeinfo)
-        return
-
-    if not should_send(nukeinfo['_id'], app.config['NUKE_RATELIMIT']):
-        return False
-
-    leaguebot.services.alerters.slack.sendNukeMessage(nukeinfo)
-    leaguebot.services.alerters.twitter.sendNukeMessage(nukeinfo)
-    mark_sent(nukeinfo['_id'])
 
+def sendNukeMessages(nukes):
+    """
+    Sends alerts for the given nukes, checking and recording which have already been alerted on in bulk.
+    :param nukes: Nukes, in the order their alerts should be sent.
+    :return: The number of nukes alerted on in full.
+    """
+    tick = screeps.get_time()
+    nukes = [nukeinfo for nukeinfo in nukes if screepmap.getRoomOwner(nukeinfo['room'])]
+    rate_limited_ids = [nukeinfo['_id'] for nukeinfo in nukes if nukeinfo['landTime'] - tick >= 25]
+    recently_sent = get_recently_sent(rate_limited_ids, app.config['NUKE_RATELIMIT'], tick)
+
+    sent_ids = []
+    try:
+        for nukeinfo in nukes:
+            eta = nukeinfo['landTime'] - tick
+            if eta < 25:
+                # Nukes about to land are always announced on slack, but never tweeted.
+                leaguebot.services.alerters.slack.sendNukeMessage(nukeinfo)
+                continue
+
+            if nukeinfo['_id'] in recently_sent:
+                continue
+
+            leaguebot.services.alerters.slack.sendNukeMessage(nukeinfo)
+            leaguebot.services.alerters.twitter.sendNukeMessage(nukeinfo)
+            sent_ids.append(nukeinfo['_id'])
+    finally:
+        # Record the nukes already alerted on even if a later alert fails, so they aren't sent again next time.
+        mark_all_sent(sent_ids, tick)
+    return len(sent_ids)
@@ -1,24 +1,46 @@
 from leaguebot import app
 import sqlite3
+import threading
 from flask import g
 
 if 'SQLLITE_PATH' not in app.config:
     app.config['SQLLITE_PATH'] = '/tmp/leaguebot/sqlite'
 
+# SQLite limits the number of parameters in one statement (999 by default), so IN queries are split into chunks.
+MAX_QUERY_PARAMETERS = 900
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _prepare_database(conn):
+    """
+    Sets up the database once per process: creates the tables, and switches to WAL mode so that readers and the writer
+    don't block each other.
+    """
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute('PRAGMA journal_mode=WAL')
+        with conn:
+            conn.execute('''
+            create table if not exists ALERTS (
+                id TEXT PRIMARY KEY,
+                tick INTEGER NOT NULL
+            )
+            ''')
+            conn.execute('create index if not exists ALERTS_TICK on ALERTS (tick)')
+        _schema_ready = True
+
 
 def get_conn():
     conn = getattr(g, '_database', None)
     if conn is None:
-        g._database = sqlite3.connect(app.config['SQLLITE_PATH'])
-        create_table_sql = '''
-        create table if not exists ALERTS (
-            id TEXT PRIMARY KEY,
-            tick INTEGER NOT NULL
-        )
-        '''
-        g._database.cursor().execute(create_table_sql)
+        conn = g._database = sqlite3.connect(app.config['SQLLITE_PATH'])
+        _prepare_database(conn)
 
-    return g._database
+    return conn
 
 
 @app.teardown_appcontext
@@ -39,12 +61,30 @@ def runQuery(query, params=None):
     conn.commit()
     return cursor
 
+
+def _select(query, params=None):
+    # Reads don't need a commit.
+    if params is not None:
+        return get_conn().execute(query, params)
+    return get_conn().execute(query)
+
+
 def find_one(query, params=None):
-    return runQuery(query, params).fetchone()
+    return _select(query, params).fetchone()
 
 
 def find_all(query, params=None):
-    return runQuery(query, params).fetchall()
+    return _select(query, params).fetchall()
+
 
 def execute(query, params=None):
     runQuery(query, params)
+
+
+def execute_many(query, params_list):
+    """
+    Runs a statement once for each set of parameters, all in a single transaction.
+    """
+    conn = get_conn()
+    with conn:
+        conn.executemany(query, params_list)
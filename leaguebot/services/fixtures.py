@@ -0,0 +1,188 @@
+"""
+Recorded HTTP responses, for running LeagueBot offline against a local fake of screeps.com and
+leagueofautomatednations.com.
+
+When HTTP_RECORD_DIR is set, every response fetched through http_client is saved there, one file per URL. The
+serve_fixtures command then replays them: point SCREEPS_URL and LOAN_URL at it, with the original host as the first
+path segment (for example http://localhost:8080/screeps.com/), and every screeps.com and LOAN request is served
+locally. Slack, Twitter and the link shortener don't go through http_client: set MESSAGE_SINK='log' as well so that
+messages are only logged, see routes/replay.py.
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+from leaguebot import app
+
+__all__ = ["fixture_path", "record_response", "load_fixture", "FixtureServer"]
+
+logger = app.logger
+
+# Response headers kept when recording. Everything else (dates, cookies, encodings) would be wrong when replayed.
+_RECORDED_HEADERS = ('content-type', 'etag', 'last-modified')
+
+_unsafe_path_characters = re.compile(r'[^A-Za-z0-9._/-]')
+
+_write_lock = threading.Lock()
+
+
+def fixture_path(fixture_dir, host, path, query=''):
+    """
+    Gets the file a response is stored in: the host and path, with a hash of the query string if there is one.
+    :param query: The raw query string. Parameters are sorted first, so the order they're given in doesn't matter.
+    """
+    name = _unsafe_path_characters.sub('_', '{}/{}'.format(host, path.strip('/')).replace('..', '_'))
+    if query:
+        sorted_query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+        name += '@' + hashlib.sha1(sorted_query.encode()).hexdigest()[:16]
+    return os.path.join(fixture_dir, name + '.fixture')
+
+
+def record_response(fixture_dir, response):
+    """
+    Saves a response so that it can be replayed.
+    :type response: requests.Response
+    """
+    if response.status_code == 304:
+        # Only says the already recorded response is still current.
+        return
+    url = urlsplit(response.url)
+    path = fixture_path(fixture_dir, url.netloc, url.path, url.query)
+    fixture = {
+        'url': response.url,
+        'status': response.status_code,
+        'headers': {name: response.headers[name] for name in _RECORDED_HEADERS if name in response.headers},
+        'body': base64.b64encode(response.content).decode('ascii'),
+    }
+    with _write_lock:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(fixture, f)
+        os.replace(temp_path, path)
+
+
+def load_fixture(fixture_dir, host, path, query=''):
+    """
+    :return: A tuple of (status, headers, body), or None if no response was recorded for the request.
+    """
+    try:
+        with open(fixture_path(fixture_dir, host, path, query)) as f:
+            fixture = json.load(f)
+    except FileNotFoundError:
+        return None
+    return fixture['status'], fixture['headers'], base64.b64decode(fixture['body'])
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FixtureServer(object):
+    """
+    A local HTTP server replaying recorded responses, with added latency, and 404s for some requests.
+
+    Requests are for /<original host>/<original path>. Requests without a recorded response get a 404, like missing
+    history segments do.
+    """
+
+    def __init__(self, fixture_dir, host='127.0.0.1', port=8080, latency=0.0, jitter=0.0, not_found_pattern=None,
+                 not_found_rate=0.0, seed=None):
+        """
+        :param latency: Seconds to wait before each response.
+        :param jitter: Most seconds added to or taken from the latency, at random.
+        :param not_found_pattern: Regex: only requests with a matching path get forced 404s. If None, any request can.
+        :param not_found_rate: Chance of a 404 for each request which can get one, even if a response was recorded.
+        """
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self.not_found_pattern = re.compile(not_found_pattern) if not_found_pattern else None
+        self.not_found_rate = not_found_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.stats = {'requests': 0, 'replayed': 0, 'not_modified': 0, 'not_found': 0, 'forced_not_found': 0}
+        self._stats_lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), self._make_handler())
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            self.stats[stat] += 1
+
+    def _delay(self):
+        with self._random_lock:
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _force_not_found(self, path):
+        if not self.not_found_rate:
+            return False
+        if self.not_found_pattern is not None and not self.not_found_pattern.search(path):
+            return False
+        with self._random_lock:
+            return self._random.random() < self.not_found_rate
+
+    def respond(self, raw_path, request_headers):
+        """
+        :return: A tuple of (status, headers, body) for a request.
+        """
+        url = urlsplit(raw_path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        self._delay()
+        if self._force_not_found(url.path):
+            self._count('forced_not_found')
+            return 404, {}, b''
+        fixture = load_fixture(self.fixture_dir, host, path, url.query)
+        if fixture is None:
+            self._count('not_found')
+            return 404, {}, b''
+        status, headers, body = fixture
+        etag = headers.get('etag')
+        if status == 200 and etag is not None and request_headers.get('If-None-Match') == etag:
+            self._count('not_modified')
+            return 304, {'etag': etag}, b''
+        self._count('replayed')
+        return status, headers, body
+
+    def _make_handler(self):
+        fixture_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps connections open between requests, like the real servers do.
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers, body = fixture_server.respond(self.path, self.headers)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Fixture server: " + format % args)
+
+        return Handler
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
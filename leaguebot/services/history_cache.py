@@ -0,0 +1,230 @@
+"""
+A persistent on-disk cache for room history segments.
+
+Once a room-history segment has been generated by the server it never changes, so segments are stored forever (until
+evicted) under CACHE_ROOT/history, keyed by room and tick, compressed with zlib. Files are touched whenever they're
+read, and when the cache grows over HISTORY_CACHE_MAX_BYTES the least recently used files are deleted.
+
+The cache is shared by every process using the same CACHE_ROOT.
+
+Segments which don't exist yet are remembered too, in redis: after a 404 error, a segment isn't requested again until
+the game has moved far enough past it that it could plausibly have been generated.
+"""
+import os
+import threading
+import zlib
+
+from leaguebot import app
+from leaguebot.services import redis_data
+from leaguebot.static_constants import HISTORY_MISSING_RETRY_TICKS
+
+__all__ = ["get", "put", "is_known_missing", "mark_missing", "get_earliest_request_tick", "get_stats"]
+
+app.config.setdefault('CACHE_ROOT', '/tmp/leaguebot/cache')
+app.config.setdefault('HISTORY_CACHE_ENABLED', True)
+app.config.setdefault('HISTORY_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+# When evicting, delete files until the cache is this fraction of the maximum size, so we don't evict on every write.
+_EVICT_TO_FRACTION = 0.8
+
+logger = app.logger
+
+_lock = threading.Lock()
+# Approximate total size of the cache directory. This is None until the directory has been scanned once, and is only an
+# estimate when multiple processes share the cache - it's corrected each time we scan the directory while evicting.
+_total_bytes = None
+# Bytes stored by other threads while the directory is being scanned, since the scan may have missed them. None when no
+# scan is running.
+_bytes_written_while_evicting = None
+# Held while evicting, so that only one thread in the process scans the directory and deletes files at a time.
+_evict_lock = threading.Lock()
+_stats = {
+    'hits': 0,
+    'misses': 0,
+    'stores': 0,
+    'evictions': 0,
+    'bytes_read': 0,
+    'bytes_written': 0,
+    'bytes_evicted': 0,
+    'missing_suppressed': 0,
+    'missing_marked': 0,
+}
+
+
+def _cache_dir():
+    return os.path.join(app.config['CACHE_ROOT'], 'history')
+
+
+def _segment_path(room, tick):
+    return os.path.join(_cache_dir(), room, '{}.json.z'.format(tick))
+
+
+def _count(**counts):
+    with _lock:
+        for name, amount in counts.items():
+            _stats[name] += amount
+
+
+def get(room, tick):
+    """
+    Gets a cached history segment.
+    :return: The raw (uncompressed) segment content, or None if it isn't cached.
+    :rtype: bytes | None
+    """
+    if not app.config['HISTORY_CACHE_ENABLED']:
+        return None
+    path = _segment_path(room, tick)
+    try:
+        with open(path, 'rb') as f:
+            compressed = f.read()
+        content = zlib.decompress(compressed)
+    except FileNotFoundError:
+        _count(misses=1)
+        return None
+    except (OSError, zlib.error):
+        logger.exception("Error reading cached history at {}. Ignoring.".format(path))
+        _count(misses=1)
+        return None
+    try:
+        # Mark as recently used for eviction.
+        os.utime(path)
+    except OSError:
+        pass  # It may have just been evicted by another process, but we have the content anyways.
+    _count(hits=1, bytes_read=len(compressed))
+    return content
+
+
+def put(room, tick, content):
+    """
+    Stores a history segment. This should only be called with complete, valid segments, as they're cached forever.
+    :param content: The raw segment content, as returned by the server.
+    :type content: bytes
+    """
+    global _total_bytes, _bytes_written_while_evicting
+    if not app.config['HISTORY_CACHE_ENABLED']:
+        return
+    path = _segment_path(room, tick)
+    compressed = zlib.compress(content)
+    temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, 'wb') as f:
+            f.write(compressed)
+        # Rename so that other processes never see partially written files.
+        os.replace(temp_path, path)
+    except OSError:
+        logger.exception("Error writing cached history to {}. Ignoring.".format(path))
+        return
+    _count(stores=1, bytes_written=len(compressed))
+
+    with _lock:
+        if _total_bytes is not None:
+            _total_bytes += len(compressed)
+        if _bytes_written_while_evicting is not None:
+            _bytes_written_while_evicting += len(compressed)
+        needs_eviction = _total_bytes is None or _total_bytes > app.config['HISTORY_CACHE_MAX_BYTES']
+    if needs_eviction:
+        _evict()
+
+
+def _evict():
+    """
+    Scans the cache directory, recounting its size, and deletes the least recently used segments if it's too large.
+
+    Does nothing if another thread is already evicting: it will account for anything stored meanwhile.
+    """
+    if not _evict_lock.acquire(blocking=False):
+        return
+    try:
+        _evict_locked()
+    finally:
+        _evict_lock.release()
+
+
+def _evict_locked():
+    global _total_bytes, _bytes_written_while_evicting
+    with _lock:
+        _bytes_written_while_evicting = 0
+    files = []
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(_cache_dir()):
+        for file_name in file_names:
+            path = os.path.join(dir_path, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+    max_bytes = app.config['HISTORY_CACHE_MAX_BYTES']
+    if total > max_bytes:
+        target = max_bytes * _EVICT_TO_FRACTION
+        evictions = 0
+        evicted_bytes = 0
+        for mtime, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evictions += 1
+            evicted_bytes += size
+        logger.debug("Evicted {} cached history segments ({} bytes).".format(evictions, evicted_bytes))
+        _count(evictions=evictions, bytes_evicted=evicted_bytes)
+
+    with _lock:
+        # Segments stored during the scan may be counted twice, which only makes the next eviction come a little early.
+        _total_bytes = total + _bytes_written_while_evicting
+        _bytes_written_while_evicting = None
+
+
+def is_known_missing(room, tick, current_tick):
+    """
+    Checks whether a segment recently returned a 404 error, and the game hasn't moved far enough past that for it to be
+    worth requesting again.
+    :param current_tick: The current game tick, as estimated by screeps.get_time.
+    """
+    until_tick = redis_data.get_history_missing_until(room, tick)
+    if until_tick is not None and current_tick < until_tick:
+        _count(missing_suppressed=1)
+        return True
+    return False
+
+
+def mark_missing(room, tick, current_tick):
+    """
+    Remembers that a segment returned a 404 error at current_tick.
+
+    A segment can't exist until the game has passed its last tick. If it's already past that, the server is lagging
+    behind in generating history, so we give it HISTORY_MISSING_RETRY_TICKS more ticks before trying again.
+    """
+    segment_end = tick - tick % 20 + 20
+    redis_data.set_history_missing_until(room, tick, max(segment_end, current_tick + HISTORY_MISSING_RETRY_TICKS))
+    _count(missing_marked=1)
+
+
+def get_earliest_request_tick(room, tick):
+    """
+    Gets the earliest game tick at which requesting a segment could succeed: once the game has passed the segment's last
+    tick, and it isn't known to be missing.
+    """
+    segment_end = tick - tick % 20 + 20
+    until_tick = redis_data.get_history_missing_until(room, tick)
+    if until_tick is not None:
+        return max(segment_end, until_tick)
+    return segment_end
+
+
+def get_stats():
+    """
+    Gets statistics for this process's use of the history cache.
+    :return: A dict of 'hits', 'misses', 'stores', 'evictions', and 'bytes_read', 'bytes_written' and 'bytes_evicted'
+             (all compressed sizes), plus 'missing_suppressed' (requests skipped because the segment was known to be
+             missing) and 'missing_marked' (404 errors remembered).
+    :rtype: dict[str, int]
+    """
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,116 @@
+"""
+Decoding for room history segments.
+
+A history segment has every property of every object in the room for its first tick, and property updates for the
+rest. history.modify_data_with_history only looks at a few of those properties, so segments can optionally be decoded
+selectively: as each room object is decoded, everything but the properties we use is thrown away. That roughly halves
+the peak memory used while decoding a large segment, but calling back into Python for every object makes decoding
+slower, so it's off by default (see HISTORY_SELECTIVE_PARSE, and benchmark_history_parsing).
+
+Either the standard library json module (the default) or rapidjson (when installed) can be used to decode, see
+HISTORY_JSON_BACKEND.
+"""
+import json
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+from leaguebot import app
+
+__all__ = ["parse_history", "get_backend_names"]
+
+# 'json', 'rapidjson', or 'auto' to use rapidjson whenever it's installed. Plain json is at least as fast for history
+# segments, so only choose rapidjson after checking with benchmark_history_parsing.
+app.config.setdefault('HISTORY_JSON_BACKEND', 'json')
+# If True, properties which aren't used in processing are dropped while decoding. This uses about half the peak memory
+# for large segments, but decodes around 40% slower, so only turn it on when memory is tighter than time.
+app.config.setdefault('HISTORY_SELECTIVE_PARSE', False)
+
+logger = app.logger
+
+# Properties kept for each room object, by object type. Objects without a 'type' (property updates in ticks after the
+# first, and nested values such as action logs) are kept whole, minus any properties which are null.
+_CREEP_FIELDS = ('type', 'user', 'body', 'actionLog')
+_CONTROLLER_FIELDS = ('type', 'user', 'level', 'reservation', 'actionLog')
+
+# Other typed objects (body parts, and structures other than controllers) only need their type, and their action log
+# if they have one (towers can attack and heal). Since most of them end up as just {'type': ...}, a single shared dict
+# is used for each type. Nothing modifies decoded history, so sharing them is safe.
+_type_only_objects = {}
+
+
+def _select_fields(obj):
+    """
+    object_hook which drops all room object properties which aren't used in processing.
+    """
+    object_type = obj.get('type')
+    if object_type is None:
+        # Missing and null properties are treated the same by everything using .get(), so nulls can be dropped.
+        if None in obj.values():
+            return {name: value for name, value in obj.items() if value is not None}
+        return obj
+    elif object_type == 'creep':
+        return {name: obj[name] for name in _CREEP_FIELDS if name in obj}
+    elif object_type == 'controller':
+        return {name: obj[name] for name in _CONTROLLER_FIELDS if name in obj}
+
+    action_log = obj.get('actionLog')
+    if action_log is not None:
+        return {'type': object_type, 'actionLog': action_log}
+    type_only = _type_only_objects.get(object_type)
+    if type_only is None:
+        type_only = _type_only_objects.setdefault(object_type, {'type': object_type})
+    return type_only
+
+
+def _json_loads(text, object_hook):
+    return json.loads(text, object_hook=object_hook)
+
+
+def _rapidjson_loads(text, object_hook):
+    return rapidjson.loads(text, object_hook=object_hook)
+
+
+_BACKENDS = {
+    'json': _json_loads,
+}
+if rapidjson is not None:
+    _BACKENDS['rapidjson'] = _rapidjson_loads
+
+
+def get_backend_names():
+    """
+    :return: The names of all JSON backends which are available.
+    :rtype: list[str]
+    """
+    return sorted(_BACKENDS.keys())
+
+
+def _get_backend(name):
+    if name == 'auto':
+        name = 'rapidjson' if 'rapidjson' in _BACKENDS else 'json'
+    elif name not in _BACKENDS:
+        logger.warning("JSON backend {} isn't available, using json instead.".format(name))
+        name = 'json'
+    return _BACKENDS[name]
+
+
+def parse_history(content, selective=None, backend=None):
+    """
+    Decodes a room history segment.
+    :param content: The raw segment content.
+    :type content: bytes
+    :param selective: Whether to drop unused room object properties. Defaults to the HISTORY_SELECTIVE_PARSE setting.
+    :param backend: 'json', 'rapidjson' or 'auto'. Defaults to the HISTORY_JSON_BACKEND setting.
+    :return: The decoded segment.
+    :raises ValueError: if the content isn't valid JSON.
+    """
+    if selective is None:
+        selective = app.config['HISTORY_SELECTIVE_PARSE']
+    if backend is None:
+        backend = app.config['HISTORY_JSON_BACKEND']
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return _get_backend(backend)(content, _select_fields if selective else None)
@@ -0,0 +1,106 @@
+"""
+The shared HTTP client used for every outbound fetch to screeps.com and leagueofautomatednations.com.
+
+All requests go through one pooled requests.Session, so connections (and their TCP/TLS handshakes) are kept alive and
+reused between calls, including calls made from worker threads.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from leaguebot import app
+from leaguebot.services import fixtures
+
+__all__ = ["get", "get_session", "get_connection_stats"]
+
+# Number of hosts to keep connection pools for.
+app.config.setdefault('HTTP_POOL_CONNECTIONS', 4)
+# Maximum number of connections kept open to a single host.
+app.config.setdefault('HTTP_POOL_MAXSIZE', 16)
+# Timeout in seconds, used for both connecting and reading.
+app.config.setdefault('HTTP_TIMEOUT', 15)
+# Number of retries for connection errors and 5xx responses, and the exponential backoff factor between them.
+app.config.setdefault('HTTP_RETRIES', 2)
+app.config.setdefault('HTTP_RETRY_BACKOFF', 0.5)
+# Base URLs of screeps.com and leagueofautomatednations.com. Both can be pointed at a fake server (see serve_fixtures).
+app.config.setdefault('SCREEPS_URL', 'https://screeps.com/')
+app.config.setdefault('LOAN_URL', 'http://www.leagueofautomatednations.com/')
+# If set, every response is saved in this directory, to be replayed by serve_fixtures.
+app.config.setdefault('HTTP_RECORD_DIR', None)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _create_session():
+    retry = Retry(
+        total=app.config['HTTP_RETRIES'],
+        backoff_factor=app.config['HTTP_RETRY_BACKOFF'],
+        status_forcelist=(500, 502, 503, 504),
+        # Return the last response instead of raising once retries run out, so callers can handle it as before.
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=app.config['HTTP_POOL_CONNECTIONS'],
+        pool_maxsize=app.config['HTTP_POOL_MAXSIZE'],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """
+    Gets the process-wide HTTP session.
+    :rtype: requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _create_session()
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    Same as requests.get, but using the shared session, and the configured timeout if none is given.
+
+    Responses are recorded if HTTP_RECORD_DIR is set.
+    :rtype: requests.Response
+    """
+    kwargs.setdefault('timeout', app.config['HTTP_TIMEOUT'])
+    response = get_session().get(url, **kwargs)
+    if app.config['HTTP_RECORD_DIR']:
+        fixtures.record_response(app.config['HTTP_RECORD_DIR'], response)
+    return response
+
+
+def get_connection_stats():
+    """
+    Gets connection statistics for the shared session.
+
+    Note: these are only counted for connection pools which are still open - pools evicted because more than
+    HTTP_POOL_CONNECTIONS hosts were used are no longer counted.
+    :return: A dict of 'requests' (total requests made), 'handshakes' (new connections opened) and 'reused'
+             (requests which reused an already open connection).
+    :rtype: dict[str, int]
+    """
+    stats = {'requests': 0, 'handshakes': 0, 'reused': 0}
+    if _session is None:
+        return stats
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats['requests'] += pool.num_requests
+            stats['handshakes'] += pool.num_connections
+    stats['reused'] = max(0, stats['requests'] - stats['handshakes'])
+    return stats
@@ -0,0 +1,73 @@
+"""
+Shortened links for outgoing messages, cached in redis.
+
+Messages are rendered with full URLs, and only shortened with shorten_links right before they're sent, so that
+rendering never waits on the shortening service.
+"""
+import re
+import threading
+
+from pyshorteners import Shortener
+
+from leaguebot import app
+from leaguebot.services import redis_data
+
+__all__ = ["shorten", "shorten_links"]
+
+# Timeout in seconds for each request to the shortening service.
+app.config.setdefault('LINK_SHORTENER_TIMEOUT', 3)
+# 'live' to post messages, or 'log' to only log them. When it's 'log', links aren't shortened either.
+app.config.setdefault('MESSAGE_SINK', 'live')
+
+logger = app.logger
+
+_URL_PATTERN = re.compile(r'https?://\S+')
+
+_shortener = None
+_shortener_lock = threading.Lock()
+
+
+def _get_shortener():
+    global _shortener
+    if _shortener is None:
+        with _shortener_lock:
+            if _shortener is None:
+                _shortener = Shortener('Isgd', timeout=app.config['LINK_SHORTENER_TIMEOUT'])
+    return _shortener
+
+
+def _shorten_uncached(url):
+    """
+    :return: The short link, or the original url if it couldn't be shortened.
+    """
+    try:
+        short_link = _get_shortener().short(url)
+    except Exception:
+        logger.warning("Couldn't shorten {}, using it as is.".format(url))
+        return url
+    redis_data.set_short_link(url, short_link)
+    return short_link
+
+
+def shorten(url):
+    """
+    Shortens a single url, falling back to the url itself if the shortening service fails.
+    """
+    return shorten_links(url)
+
+
+def shorten_links(text):
+    """
+    Replaces every URL in some text with a short link. Short links are looked up in the cache all at once, and only
+    the URLs which aren't cached are sent to the shortening service.
+    """
+    if app.config['MESSAGE_SINK'] == 'log':
+        return text
+    urls = set(_URL_PATTERN.findall(text))
+    if not urls:
+        return text
+    short_links = redis_data.get_short_links(urls)
+    for url in urls:
+        if url not in short_links:
+            short_links[url] = _shorten_uncached(url)
+    return _URL_PATTERN.sub(lambda match: short_links[match.group(0)], text)
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict
+
+__all__ = ["LRUCache"]
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded, process-local cache which evicts the least recently used keys first.
+
+    If a ttl (in seconds) is given, values also expire that long after they're set.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Maps key to (value, expiry time or None), in order of use.
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get_locked(self, key, now):
+        """
+        :return: A tuple of (found, value).
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get_locked(key, time.monotonic())
+        return value if found else default
+
+    def get_many(self, keys):
+        """
+        :return: A dict of key to value, for each of the given keys which is cached.
+        """
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for key in keys:
+                found, value = self._get_locked(key, now)
+                if found:
+                    result[key] = value
+        return result
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        """
+        :param ttl: Overrides this cache's ttl for these values.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (value, expires_at)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,78 @@
+import time
+
+from leaguebot.services import redis_data
+
+__all__ = ["TokenBucket"]
+
+# Refills a token bucket for the time since it was last refilled, and takes a token if there is one. Buckets which
+# haven't been used in long enough to refill completely expire, since a missing bucket is treated as full.
+# Keys should be [bucket_key]
+# Args should be [rate, capacity, now]
+# Returns [1 if a token was taken else 0, seconds until the next token (as a string)]
+_take_token_script = redis_data.lua_script("""
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('expire', KEYS[1], math.ceil(capacity / rate) + 1)
+return {taken, tostring(wait)}
+""")
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter stored in redis: allows bursts of up to `capacity` actions, refilling at `rate` actions
+    per second. Every process using the same key shares the bucket, so limits hold across cron runs and workers.
+
+    Needs an app context, for the redis connection.
+    """
+
+    def __init__(self, key, rate, capacity):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+
+    def _take(self):
+        """
+        :return: A tuple of (whether a token was taken, seconds until the next token is available).
+        """
+        redis_conn = redis_data.get_connection()
+        seconds, microseconds = redis_conn.time()
+        taken, wait = _take_token_script(keys=[self.key],
+                                         args=[self.rate, self.capacity, seconds + microseconds / 1000000],
+                                         client=redis_conn)
+        return bool(taken), float(wait)
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available, without waiting.
+        :return: True if a token was taken.
+        """
+        return self._take()[0]
+
+    def acquire(self, timeout=None):
+        """
+        Takes a token, waiting for one to become available if needed.
+        :param timeout: The most seconds to wait, or None to wait as long as it takes.
+        :return: True if a token was taken, False if none became available within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            taken, wait = self._take()
+            if taken:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
@@ -34,12 +34,13 @@ Initial starting history segment found, and past history segments searched, but
         # ...
     },
 
-    # A list of creep IDs which we have already added to the creeps map
-    'creeps_found': [
+    # A set of creep IDs which we have already added to the creeps map. This isn't stored in the JSON data itself, but
+    # in a separate redis set which is only ever added to (see set_ongoing_data).
+    'creeps_found': {
         '582f8e657a1fc8bf5cd28be5',
         '582f8116e8c62a5d2e464ad2',
         # ...
-    ]
+    }
 
     # The room's owner / reserver, or null if unowned and unreserved.
     owner: 'screepsuser',
@@ -119,38 +120,75 @@ try:
 except ImportError:
     import json
 
+import hashlib
+import threading
+
 import redis
 from flask import g
 
 from leaguebot import app
 from leaguebot.static_constants import USERNAME_CACHE_EXPIRE, USERNAME_CACHE_KEY, BATTLE_DATA_KEY, BATTLE_DATA_EXPIRE, \
-    ALLIANCES_FETCHED_KEY, ALLIANCES_FETCHED_EXPIRE, ALLIANCE_CACHE_KEY, ALLIANCE_CACHE_EXPIRE, LAST_CHECKED_TICK_KEY, \
-    LAST_CHECKED_TICK_EXPIRE
-
-__all__ = ["get_username", "set_username", "set_ongoing_data", "get_ongoing_data", "is_alliance_data_recent",
-           "update_alliance_data", "get_cached_alliance"]
+    BATTLE_CREEPS_KEY, SHORT_LINK_CACHE_KEY, SHORT_LINK_CACHE_EXPIRE, \
+    ALLIANCE_DATA_KEY, ALLIANCE_DATA_VERSION_KEY, ALLIANCE_DATA_VALIDATORS_KEY, ALLIANCE_DATA_FETCHED_KEY, \
+    LAST_CHECKED_TICK_KEY, LAST_CHECKED_TICK_EXPIRE, HISTORY_MISSING_KEY, \
+    HISTORY_MISSING_EXPIRE
+
+__all__ = ["lua_script",
+           "get_username", "set_username", "get_usernames", "set_usernames", "get_short_links", "set_short_link",
+           "set_ongoing_data", "get_ongoing_data",
+           "get_alliance_data_status", "get_alliance_data", "get_alliance_data_validators", "update_alliance_data",
+           "mark_alliance_data_fetched",
+           "get_history_missing_until", "set_history_missing_until"]
 
 app.config.setdefault('REDIS_HOST', 'localhost')
 app.config.setdefault('REDIS_PORT', 6379)
 app.config.setdefault('REDIS_DATABASE', 0)
 
 
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def _get_connection_pool():
+    """
+    Gets the process-wide redis connection pool, so that app contexts pushed by worker threads share connections.
+    :rtype: redis.ConnectionPool
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        with _connection_pool_lock:
+            if _connection_pool is None:
+                _connection_pool = redis.ConnectionPool(
+                    host=app.config['REDIS_HOST'],
+                    port=app.config['REDIS_PORT'],
+                    db=app.config['REDIS_DATABASE'],
+                    password=app.config.get('REDIS_PASSWORD')
+                )
+    return _connection_pool
+
+
 def get_connection():
     """
     :rtype: redis.StrictRedis
     """
     connection = getattr(g, 'redis_connection', None)
     if connection is None:
-        connection = redis.StrictRedis(
-            host=app.config['REDIS_HOST'],
-            port=app.config['REDIS_PORT'],
-            db=app.config['REDIS_DATABASE'],
-            password=app.config.get('REDIS_PASSWORD')
-        )
+        connection = redis.StrictRedis(connection_pool=_get_connection_pool())
         g.redis_connection = connection
     return connection
 
 
+def lua_script(source):
+    """
+    Creates a Lua script with its SHA already computed, so the first call tries EVALSHA straight away (the script is
+    most likely already loaded by another process), falling back to loading it on a NOSCRIPT error.
+    :rtype: redis.client.Script
+    """
+    script = redis.client.Script(None, source)
+    script.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    return script
+
+
 def get_username(user_id):
     """
     Gets the cached username set via the specified user_id. Meant for use via user_info.py.
@@ -168,6 +206,49 @@ def set_username(user_id, username):
     get_connection().set(key, username, ex=USERNAME_CACHE_EXPIRE)
 
 
+def get_usernames(user_ids):
+    """
+    Gets the cached usernames for many user_ids at once.
+    :return: A dict of user_id to username, for each user_id which has a cached username.
+    :rtype: dict[str, str]
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return {}
+    raw_names = get_connection().mget([USERNAME_CACHE_KEY.format(user_id) for user_id in user_ids])
+    return {user_id: raw.decode() for user_id, raw in zip(user_ids, raw_names) if raw is not None}
+
+
+def set_usernames(usernames_by_id):
+    """
+    Caches many usernames at once.
+    :param usernames_by_id: A dict of user_id to username.
+    """
+    if not usernames_by_id:
+        return
+    pipe = get_connection().pipeline(transaction=False)
+    for user_id, username in usernames_by_id.items():
+        pipe.set(USERNAME_CACHE_KEY.format(user_id), username, ex=USERNAME_CACHE_EXPIRE)
+    pipe.execute()
+
+
+def get_short_links(urls):
+    """
+    Gets the cached shortened links for many URLs at once. Meant for use via link_shortener.py.
+    :return: A dict of url to short link, for each url which has a cached short link.
+    :rtype: dict[str, str]
+    """
+    urls = list(urls)
+    if not urls:
+        return {}
+    raw_links = get_connection().mget([SHORT_LINK_CACHE_KEY.format(url) for url in urls])
+    return {url: raw.decode() for url, raw in zip(urls, raw_links) if raw is not None}
+
+
+def set_short_link(url, short_link):
+    get_connection().set(SHORT_LINK_CACHE_KEY.format(url), short_link, ex=SHORT_LINK_CACHE_EXPIRE)
+
+
 def get_latest_fetched_tick():
     """
     Gets the latest tick fetched for battles.
@@ -187,54 +268,144 @@ def set_latest_fetched_tick(tick):
     get_connection().set(LAST_CHECKED_TICK_KEY, tick, ex=LAST_CHECKED_TICK_EXPIRE)
 
 
-def set_ongoing_data(room_name, data_map):
+def get_history_missing_until(room_name, tick):
+    """
+    Gets the tick until which a missing history segment shouldn't be requested again. Meant for use via history_cache.
+    :return: The tick, or None if the segment isn't known to be missing.
+    """
+    raw = get_connection().get(HISTORY_MISSING_KEY.format(room_name, tick))
+    if raw is None:
+        return None
+    else:
+        return int(raw)
+
+
+def set_history_missing_until(room_name, tick, until_tick):
+    """
+    Sets the tick until which a missing history segment shouldn't be requested again.
+    """
+    get_connection().set(HISTORY_MISSING_KEY.format(room_name, tick), until_tick, ex=HISTORY_MISSING_EXPIRE)
+
+
+def set_ongoing_data(room_name, data_map, new_creeps_found=()):
     """
     Sets the "currently process" data for a given room name.
 
-    This stores the data map into redis as JSON.
+    This stores the data map into redis as JSON, except for 'creeps_found', which is kept in a redis set so that only
+    newly found creeps need to be written each time.
 
     :param room_name: The room
     :param data_map: The data map, in the "battle data" format described in module docs.
+    :param new_creeps_found: Creep IDs which have been added to data_map['creeps_found'] since it was retrieved with
+                             get_ongoing_data.
     """
     key = BATTLE_DATA_KEY.format(room_name)
-    get_connection().set(key, json.dumps(data_map), ex=BATTLE_DATA_EXPIRE)
+    creeps_key = BATTLE_CREEPS_KEY.format(room_name)
+    stored_map = {name: value for name, value in data_map.items() if name != 'creeps_found'}
+    pipe = get_connection().pipeline()
+    pipe.set(key, json.dumps(stored_map), ex=BATTLE_DATA_EXPIRE)
+    if new_creeps_found:
+        pipe.sadd(creeps_key, *new_creeps_found)
+    pipe.expire(creeps_key, BATTLE_DATA_EXPIRE)
+    pipe.execute()
 
 
 def get_ongoing_data(room_name):
     """
     Gets the "currently processing" data for a given room name, set with set_ongoing_data.
     :return: the data
-    :rtype: dict[str, int | list[str] | dict[str, dict[str, str]]]
+    :rtype: dict[str, int | set[str] | dict[str, dict[str, str]]]
     """
     key = BATTLE_DATA_KEY.format(room_name)
-    raw = get_connection().get(key)
+    creeps_key = BATTLE_CREEPS_KEY.format(room_name)
+    pipe = get_connection().pipeline()
+    pipe.get(key)
+    pipe.smembers(creeps_key)
+    raw, raw_creeps = pipe.execute()
     if raw is None:
         return None
-    else:
-        return json.loads(raw.decode())
-
-
-def is_alliance_data_recent():
-    return get_connection().exists(ALLIANCES_FETCHED_KEY)
+    data_map = json.loads(raw.decode())
+    if 'tick_to_check' not in data_map:
+        creeps_found = {creep_id.decode() for creep_id in raw_creeps}
+        if 'creeps_found' in data_map:
+            # Data stored before creeps were kept in a separate set: move them over so they aren't lost next time the
+            # data is stored.
+            creeps_found.update(data_map['creeps_found'])
+            if data_map['creeps_found']:
+                get_connection().sadd(creeps_key, *data_map['creeps_found'])
+        data_map['creeps_found'] = creeps_found
+    return data_map
+
+
+def get_alliance_data_status():
+    """
+    Checks the alliance data in a single round trip - meant for use through models.alliances.
+    :return: A tuple of (is_recent, version). is_recent is False when alliance data should be fetched again, and the
+             version is 0 if no alliance data has been stored yet.
+    :rtype: (bool, int)
+    """
+    pipe = get_connection().pipeline(transaction=False)
+    pipe.exists(ALLIANCE_DATA_FETCHED_KEY)
+    pipe.get(ALLIANCE_DATA_VERSION_KEY)
+    is_recent, raw_version = pipe.execute()
+    return bool(is_recent), int(raw_version or 0)
 
 
-def update_alliance_data(user_alliance_tuple_list):
+def get_alliance_data():
+    """
+    Gets all alliance data, along with the version it belongs to.
+    :return: A tuple of (version, alliances), where alliances is a dict of abbreviation to
+             {'name': ..., 'members': [...]}.
+    :rtype: (int, dict[str, dict])
+    """
     pipe = get_connection().pipeline()
-    pipe.set(ALLIANCES_FETCHED_KEY, 1, ex=ALLIANCES_FETCHED_EXPIRE)
-    for user, alliance in user_alliance_tuple_list:
-        pipe.set(ALLIANCE_CACHE_KEY.format(user), alliance, ex=ALLIANCE_CACHE_EXPIRE)
-    pipe.execute()
+    pipe.get(ALLIANCE_DATA_VERSION_KEY)
+    pipe.hgetall(ALLIANCE_DATA_KEY)
+    raw_version, raw_alliances = pipe.execute()
+    return int(raw_version or 0), {abbreviation.decode(): json.loads(alliance.decode())
+                                   for abbreviation, alliance in raw_alliances.items()}
 
 
-def get_cached_alliance(username):
+def get_alliance_data_validators():
+    """
+    :return: A dict with the 'etag' and 'last-modified' headers the alliance data was last fetched with, when it had
+             them.
+    :rtype: dict[str, str]
     """
-    Get the cached alliance name - meant for use through models.user_info.
+    raw_validators = get_connection().hgetall(ALLIANCE_DATA_VALIDATORS_KEY)
+    return {name.decode(): value.decode() for name, value in raw_validators.items()}
 
-    Note: be sure to check if is_alliance_data_recent() before using this, or you could get incorrect/old results.
+
+def update_alliance_data(changed, removed, validators, expire):
     """
-    key = ALLIANCE_CACHE_KEY.format(username)
-    raw = get_connection().get(key)
-    if raw is None:
-        return None
+    Updates some alliances, all in one transaction, and marks the alliance data as recent.
+    :param changed: A dict of abbreviation to {'name': ..., 'members': [...]} for new and changed alliances.
+    :param removed: Abbreviations of alliances which no longer exist.
+    :param validators: See get_alliance_data_validators.
+    :param expire: Seconds until the data should be fetched again.
+    :return: The version of the alliance data after updating.
+    :rtype: int
+    """
+    pipe = get_connection().pipeline()
+    if changed:
+        pipe.hmset(ALLIANCE_DATA_KEY, {abbreviation: json.dumps(alliance)
+                                       for abbreviation, alliance in changed.items()})
+    if removed:
+        pipe.hdel(ALLIANCE_DATA_KEY, *removed)
+    pipe.delete(ALLIANCE_DATA_VALIDATORS_KEY)
+    if validators:
+        pipe.hmset(ALLIANCE_DATA_VALIDATORS_KEY, validators)
+    if changed or removed:
+        pipe.incr(ALLIANCE_DATA_VERSION_KEY)
     else:
-        return raw.decode()
+        pipe.get(ALLIANCE_DATA_VERSION_KEY)
+    pipe.set(ALLIANCE_DATA_FETCHED_KEY, 1, ex=expire)
+    return int(pipe.execute()[-2] or 0)
+
+
+def mark_alliance_data_fetched(expire):
+    """
+    Marks the alliance data as recent without changing it, so that fetching isn't tried again until it expires.
+    :param expire: Seconds until the data should be fetched again.
+    """
+    get_connection().set(ALLIANCE_DATA_FETCHED_KEY, 1, ex=expire)
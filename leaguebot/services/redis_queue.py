@@ -2,105 +2,437 @@ try:
     import rapidjson as json
 except ImportError:
     import json
+import os
+import socket
+import time
+import uuid
 
 import redis
 
 from leaguebot import app
 from leaguebot.services import redis_data
-from leaguebot.static_constants import PROCESSING_QUEUE_SET, PROCESSING_QUEUE, REPORTING_QUEUE, BATTLE_DATA_EXPIRE, \
-    BATTLE_DATA_KEY, KEEP_IN_QUEUE_FOR_MAX_TICKS, ROOM_LAST_BATTLE_END_TICK_KEY, ROOM_LAST_BATTLE_END_TICK_EXPIRE, \
+from leaguebot.static_constants import PROCESSING_QUEUE_SET, PROCESSING_SCHEDULE, LEGACY_PROCESSING_QUEUE, \
+    PROCESSING_LEASES, PROCESSING_LEASE_OWNERS, REPORTING_QUEUE, BATTLE_DATA_EXPIRE, BATTLE_DATA_KEY, \
+    BATTLE_CREEPS_KEY, KEEP_IN_QUEUE_FOR_MAX_TICKS, ROOM_LAST_BATTLE_END_TICK_KEY, ROOM_LAST_BATTLE_END_TICK_EXPIRE, \
     LAST_CHECKED_TICK_KEY, LAST_CHECKED_TICK_EXPIRE, TWITTER_QUEUE, SLACK_QUEUE
 
+# Seconds a claimed room stays leased to a worker without a heartbeat. After this, the room is handed to another worker.
+app.config.setdefault('PROCESSING_LEASE_SECONDS', 120)
+# Seconds a pulled message is hidden from other workers, unless it's finished or released before then.
+app.config.setdefault('MESSAGE_LOCK_SECONDS', 300)
+# Limits for merging queued slack messages together: the longest merged message (in bytes, Slack's limit is in
+# characters), and the most messages merged into one.
+app.config.setdefault('SLACK_MAX_MESSAGE_LENGTH', 4000)
+app.config.setdefault('SLACK_MAX_MESSAGES_PER_CHUNK', 20)
+
 logger = app.logger
 
-# This is a fairly rigid, fairly small little LUA script to set a single value.
-# Keys should be [processing_queue_set_key, processing_queue_key, battle_info_key]
-# Args should be [room_name, new_room_data_if_new_room, room_data_expire_seconds]
-# This might be quite inefficient to create and pass in a new battle-data-info each call, so that could definitely
-# change in the future.
-# One other thing that might want to be changed about this is that the script currently runs once for each room.
-# I think this _is_ better than running once on a list of rooms, which could definitely be possible, because while
-# lua scripts are running the redis server pauses all other queries. However, the other way could definitely also be
-# done!
-_battle_insert_script = redis.client.Script(None, """
-local added = redis.call('sismember', KEYS[1], ARGV[1])
-if added == 0 then
-    redis.call('sadd', KEYS[1], ARGV[1])
-    redis.call('lpush', KEYS[2], ARGV[1])
-    redis.call('set', KEYS[3], ARGV[2], 'ex', ARGV[3])
+
+def _ids_key(queue):
+    return queue + ":ids"
+
+
+def _payloads_key(queue):
+    return queue + ":payloads"
+
+
+def _counts_key(queue):
+    """
+    Hash of message ID to the number of messages merged into it, for merged slack messages. Other messages count as 1.
+    """
+    return queue + ":counts"
+
+
+def _lock_key(queue, message_id):
+    return "{}:sending:{}".format(queue, message_id)
+
+
+def _next_id_key(queue):
+    """
+    Counter the IDs of new messages are taken from, so that each message queued gets its own ID, even if the same
+    message is already queued.
+    """
+    return queue + ":next-id"
+
+
+# Maximum number of rooms inserted by a single script call. Redis runs nothing else while a script runs, so very long
+# battle lists are split up to keep each pause short.
+app.config.setdefault('BATTLE_INSERT_CHUNK_SIZE', 250)
+
+
+# Queues any of the given rooms which aren't already queued, creating their initial battle data (see storage.py for
+# documentation on this format).
+# Keys should be [processing_queue_set_key, processing_schedule_key, then battle_info_key and battle_creeps_key for
+#                 each room]
+# Args should be [room_data_expire_seconds, keep_in_queue_for_max_ticks, then room_name and hostilities_tick for each
+#                 room]
+# Returns the number of rooms queued.
+_battle_insert_script = redis_data.lua_script("""
+local added = 0
+for i = 3, #ARGV, 2 do
+    local room = ARGV[i]
+    if redis.call('sadd', KEYS[1], room) == 1 then
+        local tick = tonumber(ARGV[i + 1])
+        local segment_tick = tick - tick % 20
+        local data = string.format('{"tick_to_check": %d, "stop_checking_at": %d}', tick, segment_tick + ARGV[2])
+        -- The first segment can't exist before its last tick passes.
+        redis.call('zadd', KEYS[2], segment_tick + 20, room)
+        redis.call('set', KEYS[i], data, 'ex', ARGV[1])
+        redis.call('del', KEYS[i + 1])
+        added = added + 1
+    end
 end
+return added
 """)
 
 
 def push_battles_for_processing(new_latest_tick, battles_array):
     """
-    Pushes a number of battles into the processing queue, and sets the new latest tick (one transaction).
+    Pushes a number of battles into the processing queue, then sets the new latest tick.
+
+    Rooms are inserted in chunks of BATTLE_INSERT_CHUNK_SIZE, one script call each. The latest tick is only set once
+    every chunk has been inserted, so if this fails part way through, the same battles are fetched and pushed again
+    next time (rooms which are already queued are skipped).
     :param battles_array: A list of (room_name, hostilities_tick) tuples
+    :return: The number of rooms which weren't already queued.
     """
     redis_conn = redis_data.get_connection()
-    if not _battle_insert_script.sha \
-            or not redis_conn.script_exists(_battle_insert_script.sha):
-        # Load for pipeline
-        _battle_insert_script.sha = redis_conn.script_load(_battle_insert_script.script)
-    pipe = redis_conn.pipeline()
-
-    pipe.set(LAST_CHECKED_TICK_KEY, new_latest_tick, ex=LAST_CHECKED_TICK_EXPIRE)
-
-    for room_name, hostilities_tick in battles_array:
-        _battle_insert_script(
-            keys=[PROCESSING_QUEUE_SET, PROCESSING_QUEUE, BATTLE_DATA_KEY.format(room_name)],
-            args=[room_name, json.dumps({
-                # See storage.py for documentation on this format.
-                'tick_to_check': hostilities_tick,
-                'stop_checking_at': (hostilities_tick - hostilities_tick % 20) + KEEP_IN_QUEUE_FOR_MAX_TICKS,
-            }), BATTLE_DATA_EXPIRE],
-            client=pipe,
-        )
+    chunk_size = app.config['BATTLE_INSERT_CHUNK_SIZE']
+    battles_array = list(battles_array)
+    added = 0
+    for chunk_start in range(0, len(battles_array), chunk_size):
+        keys = [PROCESSING_QUEUE_SET, PROCESSING_SCHEDULE]
+        args = [BATTLE_DATA_EXPIRE, KEEP_IN_QUEUE_FOR_MAX_TICKS]
+        for room_name, hostilities_tick in battles_array[chunk_start:chunk_start + chunk_size]:
+            keys.extend((BATTLE_DATA_KEY.format(room_name), BATTLE_CREEPS_KEY.format(room_name)))
+            args.extend((room_name, int(hostilities_tick)))
+        added += _battle_insert_script(keys=keys, args=args, client=redis_conn)
 
-    pipe.execute()
+    redis_conn.set(LAST_CHECKED_TICK_KEY, new_latest_tick, ex=LAST_CHECKED_TICK_EXPIRE)
+    return added
+
+
+_worker_token = None
+
+
+def get_worker_token():
+    """
+    Gets the token identifying this process when claiming rooms: unique across hosts and restarts.
+    :rtype: str
+    """
+    global _worker_token
+    if _worker_token is None:
+        _worker_token = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    return _worker_token
+
+
+def _get_server_time(redis_conn):
+    """
+    Gets the current time from the redis server, so that lease times agree between workers on different hosts.
+    :rtype: float
+    """
+    seconds, microseconds = redis_conn.time()
+    return seconds + microseconds / 1000000
+
+
+# Claims the room in the processing schedule which has been due the longest, after first rescheduling rooms with expired
+# leases to be due immediately.
+# Keys should be [processing_schedule_key, leases_key, lease_owners_key]
+# Args should be [worker_token, now, lease_expiry, max_rooms_to_reclaim, current_tick]
+# Returns [claimed_room_name or false, number_of_rooms_reclaimed]
+_claim_script = redis_data.lua_script("""
+local expired = redis.call('zrangebyscore', KEYS[2], '-inf', ARGV[2], 'limit', 0, ARGV[4])
+for _, room in ipairs(expired) do
+    redis.call('zrem', KEYS[2], room)
+    redis.call('hdel', KEYS[3], room)
+    redis.call('zadd', KEYS[1], 0, room)
+end
+local room = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[5], 'limit', 0, 1)[1] or false
+if room then
+    redis.call('zrem', KEYS[1], room)
+    redis.call('zadd', KEYS[2], ARGV[3], room)
+    redis.call('hset', KEYS[3], room, ARGV[1])
+end
+return {room, #expired}
+""")
+
+# Extends the leases on rooms which are still held by the given worker.
+# Keys should be [leases_key, lease_owners_key]
+# Args should be [worker_token, lease_expiry, room_name...]
+# Returns the rooms which are still held.
+_heartbeat_script = redis_data.lua_script("""
+local held = {}
+for i = 3, #ARGV do
+    if redis.call('hget', KEYS[2], ARGV[i]) == ARGV[1] then
+        redis.call('zadd', KEYS[1], ARGV[2], ARGV[i])
+        table.insert(held, ARGV[i])
+    end
+end
+return held
+""")
+
+# Returns rooms held by the given worker to the processing schedule.
+# Keys should be [processing_schedule_key, leases_key, lease_owners_key]
+# Args should be [worker_token, room_name, due_tick, room_name, due_tick...]
+# Returns the number of rooms released.
+_release_script = redis_data.lua_script("""
+local released = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('hget', KEYS[3], ARGV[i]) == ARGV[1] then
+        redis.call('zrem', KEYS[2], ARGV[i])
+        redis.call('hdel', KEYS[3], ARGV[i])
+        redis.call('zadd', KEYS[1], ARGV[i + 1], ARGV[i])
+        released = released + 1
+    end
+end
+return released
+""")
 
 
-def get_next_room_to_process(blocking=True):
+def claim_room_to_process(current_tick, worker_token=None):
     """
-    Gets a single battle to process. This method returns the battle's room, and the stored 'battle data' from the last
-    time the battle was processed (or the beginning battle data if it hasn't been processed yet).
-    :return: A tuple of (room_name, battle_data)
+    Claims a single room which is due for processing at current_tick. The room is leased to this worker for
+    PROCESSING_LEASE_SECONDS: until the lease is released, acknowledged with submit_processed_battle, or runs out, no
+    other worker will claim it. Use renew_room_leases to keep it for longer.
+
+    Rooms whose leases have run out (because the worker holding them died) are rescheduled to be due immediately first.
+    :param current_tick: The current game tick, as estimated by screeps.get_time. A room isn't claimed before this
+                         reaches its due tick, so rooms are only claimed as promptly as the estimate is current.
+    :param worker_token: Defaults to get_worker_token().
+    :return: The claimed room name, or None if no rooms are due.
     """
+    if worker_token is None:
+        worker_token = get_worker_token()
     redis_conn = redis_data.get_connection()
-    # TODO: This implementation currently allows for the possibility of processing the same data twice when we have at
-    # least two clients, and a queue shorter than the number of clients. On one hand, this should be changed. On the
-    # other, we really only support one client at a time, and this allows us to not require a separate
-    # "currently_processing" queue to monitor.
-    if blocking:
-        return redis_conn.brpoplpush(PROCESSING_QUEUE, PROCESSING_QUEUE).decode()
+    now = _get_server_time(redis_conn)
+    raw, reclaimed = _claim_script(
+        keys=[PROCESSING_SCHEDULE, PROCESSING_LEASES, PROCESSING_LEASE_OWNERS],
+        args=[worker_token, now, now + app.config['PROCESSING_LEASE_SECONDS'], 100, current_tick],
+        client=redis_conn,
+    )
+    if reclaimed:
+        logger.warning("Reclaimed {} rooms with expired leases.".format(reclaimed))
+    if raw is None:
+        return None
     else:
-        raw = redis_conn.rpoplpush(PROCESSING_QUEUE, PROCESSING_QUEUE)
-        if raw is None:
-            return None
-        else:
-            return raw.decode()
+        return raw.decode()
+
+
+def renew_room_leases(room_names, worker_token=None):
+    """
+    Extends the leases on rooms claimed by this worker, so they aren't handed to another worker.
+    :param worker_token: Defaults to get_worker_token().
+    :return: The rooms whose leases were renewed. Any others were lost to another worker, and shouldn't be submitted.
+    :rtype: set[str]
+    """
+    room_names = list(room_names)
+    if not room_names:
+        return set()
+    if worker_token is None:
+        worker_token = get_worker_token()
+    redis_conn = redis_data.get_connection()
+    now = _get_server_time(redis_conn)
+    held = _heartbeat_script(
+        keys=[PROCESSING_LEASES, PROCESSING_LEASE_OWNERS],
+        args=[worker_token, now + app.config['PROCESSING_LEASE_SECONDS']] + room_names,
+        client=redis_conn,
+    )
+    return {raw.decode() for raw in held}
+
+
+def release_rooms(due_ticks, worker_token=None):
+    """
+    Gives up this worker's leases on rooms which still need more processing later, scheduling each for when it's next
+    worth processing.
+    :param due_ticks: A dict of room name to the earliest game tick at which processing the room could make progress.
+    :param worker_token: Defaults to get_worker_token().
+    :return: The number of rooms released.
+    """
+    if not due_ticks:
+        return 0
+    if worker_token is None:
+        worker_token = get_worker_token()
+    args = [worker_token]
+    for room_name, due_tick in due_ticks.items():
+        args.extend((room_name, due_tick))
+    return _release_script(
+        keys=[PROCESSING_SCHEDULE, PROCESSING_LEASES, PROCESSING_LEASE_OWNERS],
+        args=args,
+        client=redis_data.get_connection(),
+    )
+
+
+# Moves rooms from the processing_queue list used by older versions into the processing schedule, due immediately.
+# Keys should be [legacy_processing_queue_key, processing_schedule_key]
+# Returns the number of rooms moved.
+_migrate_rooms_script = redis_data.lua_script("""
+local rooms = redis.call('lrange', KEYS[1], 0, -1)
+for _, room in ipairs(rooms) do
+    redis.call('zadd', KEYS[2], 0, room)
+end
+redis.call('del', KEYS[1])
+return #rooms
+""")
+
+# Moves messages from a plain list queue used by older versions into an ID-addressed queue, oldest first.
+# Keys should be [legacy_queue_key, ids_key, payloads_key, next_id_key]
+# Returns the number of messages moved.
+_migrate_messages_script = redis_data.lua_script("""
+local messages = redis.call('lrange', KEYS[1], 0, -1)
+for i = #messages, 1, -1 do
+    local id = tostring(redis.call('incr', KEYS[4]))
+    redis.call('hset', KEYS[3], id, messages[i])
+    redis.call('lpush', KEYS[2], id)
+end
+redis.call('del', KEYS[1])
+return #messages
+""")
+
+
+def migrate_legacy_queues():
+    """
+    Moves anything left in the list-based queues used by older versions into the current queues.
+    """
+    redis_conn = redis_data.get_connection()
+    message_queues = (REPORTING_QUEUE, SLACK_QUEUE, TWITTER_QUEUE)
+    pipe = redis_conn.pipeline(transaction=False)
+    pipe.exists(LEGACY_PROCESSING_QUEUE)
+    for queue in message_queues:
+        pipe.exists(queue)
+    processing_exists, *message_queues_exist = pipe.execute()
+    if processing_exists:
+        moved = _migrate_rooms_script(keys=[LEGACY_PROCESSING_QUEUE, PROCESSING_SCHEDULE], client=redis_conn)
+        logger.info("Moved {} rooms from the old processing queue to the processing schedule.".format(moved))
+    for queue, exists in zip(message_queues, message_queues_exist):
+        if exists:
+            moved = _migrate_messages_script(keys=[queue, _ids_key(queue), _payloads_key(queue), _next_id_key(queue)],
+                                             client=redis_conn)
+            logger.info("Moved {} messages from the old {} list.".format(moved, queue))
+
+
+# Acknowledges a processed room: removes it from processing, and queues its battle for reporting. If a worker token is
+# given, this only happens if the worker still holds the room's lease.
+# Keys should be [processing_schedule_key, processing_queue_set_key, leases_key, lease_owners_key, battle_info_key,
+#                 battle_creeps_key, reporting_ids_key, reporting_payloads_key, room_last_battle_end_tick_key,
+#                 reporting_next_id_key]
+# Args should be [room_name, worker_token or '', battle_info_json or '', last_battle_end_tick, last_battle_end_expire]
+# Returns 1 if the room was acknowledged, 0 if the lease was lost.
+_ack_script = redis_data.lua_script("""
+if ARGV[2] ~= '' and redis.call('hget', KEYS[4], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('srem', KEYS[2], ARGV[1])
+redis.call('zrem', KEYS[3], ARGV[1])
+redis.call('hdel', KEYS[4], ARGV[1])
+redis.call('del', KEYS[5], KEYS[6])
+if ARGV[3] ~= '' then
+    local id = tostring(redis.call('incr', KEYS[10]))
+    redis.call('hset', KEYS[8], id, ARGV[3])
+    redis.call('lpush', KEYS[7], id)
+    redis.call('set', KEYS[9], ARGV[4], 'ex', ARGV[5])
+end
+return 1
+""")
 
 
-def submit_processed_battle(room_name, battle_info_dict):
+def submit_processed_battle(room_name, battle_info_dict, worker_token=None):
     """
     Submit a processed battle via a database_key and battle_info_dict.
     :param room_name: The room name that was processed
     :param battle_info_dict: The processed battle data.
+    :param worker_token: The worker which claimed the room. If given, the battle is only submitted if that worker still
+                         holds the room's lease.
+    :return: True if the battle was submitted, False if the lease was lost to another worker.
     """
-    pipe = redis_data.get_connection().pipeline()
-    pipe.lrem(PROCESSING_QUEUE, 0, room_name)
-    pipe.srem(PROCESSING_QUEUE_SET, room_name)
-    pipe.delete(BATTLE_DATA_KEY.format(room_name))
     if 'latest_hostilities_detected' in battle_info_dict:
-        pipe.lpush(REPORTING_QUEUE, json.dumps(battle_info_dict))
-        pipe.set(ROOM_LAST_BATTLE_END_TICK_KEY.format(room_name), battle_info_dict['latest_hostilities_detected'],
-                 ex=ROOM_LAST_BATTLE_END_TICK_EXPIRE)
+        raw_battle_info = json.dumps(battle_info_dict)
+        last_battle_end_tick = battle_info_dict['latest_hostilities_detected']
     else:
         # This means something has gone wrong, and no hostilities have been detected!
         # We should still remove this battle from the queue, as it was deemed 'unprocessable' by screeps_info,
         # but we shouldn't add it to the reporting queue since it wasn't processed!
         logger.debug("Battle submitted with no hostilities - not reporting battle in {}! {}".format(
             room_name, battle_info_dict))
+        raw_battle_info = ''
+        last_battle_end_tick = 0
+    submitted = _ack_script(
+        keys=[PROCESSING_SCHEDULE, PROCESSING_QUEUE_SET, PROCESSING_LEASES, PROCESSING_LEASE_OWNERS,
+              BATTLE_DATA_KEY.format(room_name), BATTLE_CREEPS_KEY.format(room_name), _ids_key(REPORTING_QUEUE),
+              _payloads_key(REPORTING_QUEUE), ROOM_LAST_BATTLE_END_TICK_KEY.format(room_name),
+              _next_id_key(REPORTING_QUEUE)],
+        args=[room_name, worker_token or '', raw_battle_info, last_battle_end_tick, ROOM_LAST_BATTLE_END_TICK_EXPIRE],
+        client=redis_data.get_connection(),
+    )
+    if not submitted:
+        logger.warning("Lease on room {} was lost before it was submitted, leaving it to the new worker."
+                       .format(room_name))
+    return bool(submitted)
+
+
+# Gets the next message from an ID-addressed queue which isn't locked by another worker, moving its ID to the back of
+# the queue and locking it. Acknowledged messages are only deleted from the payloads hash, so their IDs are dropped from
+# the list here as they're reached.
+# Keys should be [ids_key, payloads_key]
+# Args should be [lock_key_prefix, lock_seconds]
+# Returns [message_id, message], or false if the queue has no unlocked messages.
+_pull_script = redis_data.lua_script("""
+for _ = 1, redis.call('llen', KEYS[1]) do
+    local id = redis.call('rpop', KEYS[1])
+    local message = redis.call('hget', KEYS[2], id)
+    if message then
+        redis.call('lpush', KEYS[1], id)
+        if redis.call('set', ARGV[1] .. id, 1, 'nx', 'ex', ARGV[2]) then
+            return {id, message}
+        end
+    end
+end
+return false
+""")
+
+
+# Seconds to wait between pulls while every queued message is locked by another worker, doubling from the minimum up to
+# the maximum, and the most seconds to block waiting for a message to be pushed to an empty queue before checking again.
+_BLOCKING_PULL_MIN_BACKOFF = 0.1
+_BLOCKING_PULL_MAX_BACKOFF = 5
+_BLOCKING_PULL_TIMEOUT = 30
+
+
+def _pull_message(queue, blocking):
+    """
+    Pulls and locks a message: until it's finished, released, or MESSAGE_LOCK_SECONDS pass, no other worker will pull
+    it.
+    :return: A tuple of (message_id, message), or None if the queue is empty and blocking is False.
+    """
+    redis_conn = redis_data.get_connection()
+    backoff = _BLOCKING_PULL_MIN_BACKOFF
+    while True:
+        pulled = _pull_script(keys=[_ids_key(queue), _payloads_key(queue)],
+                              args=[_lock_key(queue, ''), app.config['MESSAGE_LOCK_SECONDS']], client=redis_conn)
+        if pulled is not None:
+            message_id, message = pulled
+            return message_id.decode(), message.decode()
+        if not blocking:
+            return None
+        if redis_conn.llen(_ids_key(queue)):
+            # Every queued message is locked by another worker: nothing will change until one of them finishes,
+            # releases, or its lock expires, so poll with a growing delay rather than spinning.
+            time.sleep(backoff)
+            backoff = min(backoff * 2, _BLOCKING_PULL_MAX_BACKOFF)
+        else:
+            # Wait for an ID to be pushed (this just rotates it), then pull again.
+            redis_conn.brpoplpush(_ids_key(queue), _ids_key(queue), timeout=_BLOCKING_PULL_TIMEOUT)
+            backoff = _BLOCKING_PULL_MIN_BACKOFF
+
+
+def _finish_message(queue, message_id):
+    """
+    Acknowledges a message: its payload is deleted, and its ID is dropped the next time it's pulled.
+    """
+    pipe = redis_data.get_connection().pipeline()
+    pipe.hdel(_payloads_key(queue), message_id)
+    pipe.hdel(_counts_key(queue), message_id)
+    pipe.delete(_lock_key(queue, message_id))
     pipe.execute()
 
 
@@ -109,22 +441,18 @@ def get_next_battle_to_report(blocking=True):
     Gets a single battle to report. This method returns the processed information dict, and a database_key for use when
     marking as completed.
 
+    The battle stays in the reporting queue (moved to the back) until it's marked as reported or requeued, so a worker
+    dying part way through reporting doesn't lose it.
+
     TODO: describe in detail the battle_info_dict format here.
 
     :return: A tuple of (battle_info_dict, database_key)
     """
-    # TODO: This implementation currently allows for the possibility of processing the same data twice when we have at
-    # least two clients, and a queue shorter than the number of clients. On one hand, this should be changed. On the
-    # other, we really only support one client at a time, and this allows us to not require a separate
-    # "currently_processing" queue to monitor.
-    if blocking:
-        raw_battle_info = redis_data.get_connection().brpoplpush(REPORTING_QUEUE, REPORTING_QUEUE)
-    else:
-        raw_battle_info = redis_data.get_connection().rpoplpush(REPORTING_QUEUE, REPORTING_QUEUE)
-        if raw_battle_info is None:
-            return None
-    battle_info = json.loads(raw_battle_info.decode())
-    return battle_info, raw_battle_info
+    pulled = _pull_message(REPORTING_QUEUE, blocking)
+    if pulled is None:
+        return None
+    message_id, raw_battle_info = pulled
+    return json.loads(raw_battle_info), message_id
 
 
 def mark_battle_reported(database_key):
@@ -136,7 +464,29 @@ def mark_battle_reported(database_key):
     :param database_key: The database_key returned from get_next_battle_to_report corresponding to the battle
                          successfully reported.
     """
-    redis_data.get_connection().lrem(REPORTING_QUEUE, 0, database_key)
+    _finish_message(REPORTING_QUEUE, database_key)
+
+
+# Requeues a battle from the reporting queue into the twitter and slack queues, in one operation.
+# Keys should be [reporting_payloads_key, twitter_ids_key, twitter_payloads_key, twitter_next_id_key, slack_ids_key,
+#                 slack_payloads_key, slack_next_id_key, reporting_lock_key]
+# Args should be [reporting_id or '', twitter_message or '', slack_message or '']
+_requeue_script = redis_data.lua_script("""
+if ARGV[1] ~= '' then
+    redis.call('hdel', KEYS[1], ARGV[1])
+    redis.call('del', KEYS[8])
+end
+if ARGV[2] ~= '' then
+    local id = tostring(redis.call('incr', KEYS[4]))
+    redis.call('hset', KEYS[3], id, ARGV[2])
+    redis.call('lpush', KEYS[2], id)
+end
+if ARGV[3] ~= '' then
+    local id = tostring(redis.call('incr', KEYS[7]))
+    redis.call('hset', KEYS[6], id, ARGV[3])
+    redis.call('lpush', KEYS[5], id)
+end
+""")
 
 
 def requeue_report(reporting_database_key, push_to_twitter, push_to_slack):
@@ -151,57 +501,129 @@ def requeue_report(reporting_database_key, push_to_twitter, push_to_slack):
     :param push_to_twitter: A single string to push to the twitter queue.
     :param push_to_slack: A single string to push to the slack queue.
     """
-    pipeline = redis_data.get_connection().pipeline()
-    if reporting_database_key:
-        pipeline.lrem(REPORTING_QUEUE, 0, reporting_database_key)
-    if push_to_twitter:
-        pipeline.lpush(TWITTER_QUEUE, push_to_twitter)
-    if push_to_slack:
-        pipeline.lpush(SLACK_QUEUE, push_to_slack)
-    pipeline.execute()
-
-
-# This is a small LUA script to merge all of the items in the slack queue into one item. It's done as a LUA script
-# instead of python code in order to make it a single operation.
-# The first key should be the queue to merge
-# The first argument should be the separator to use when merging.
-# TODO: should we have a limit for how many messages we merge together / the length of the message?
-_slack_merge_script = redis.client.Script(None, """
-local elements = redis.call('lrange', KEYS[1], 0, -1) -- Get all elements
-local merged = table.concat(elements, ARGV[1]) -- Merge
-redis.call('del', KEYS[1]) -- Delete all values
-redis.call('lpush', KEYS[1], merged) -- Insert the merged element
+    _requeue_script(
+        keys=[_payloads_key(REPORTING_QUEUE), _ids_key(TWITTER_QUEUE), _payloads_key(TWITTER_QUEUE),
+              _next_id_key(TWITTER_QUEUE), _ids_key(SLACK_QUEUE), _payloads_key(SLACK_QUEUE),
+              _next_id_key(SLACK_QUEUE), _lock_key(REPORTING_QUEUE, reporting_database_key or '')],
+        args=[reporting_database_key or '', push_to_twitter or '', push_to_slack or ''],
+        client=redis_data.get_connection(),
+    )
+
+
+# This is a small LUA script to merge the items in the slack queue into as few messages as possible. It's done as a LUA
+# script instead of python code in order to make it a single operation.
+# Messages are packed greedily, oldest first, into chunks no longer than the maximum length (in bytes) and containing no
+# more than the maximum count. Since message order is kept, this gives the fewest chunks possible. A single message
+# which is already too long is left as a chunk on its own. Messages locked by a worker currently sending them are left
+# alone. Chunks left from earlier merges (because they failed to send) count as the number of messages in them, so
+# merging them again never puts more than the maximum count together.
+# Keys should be [ids_key, payloads_key, counts_key, next_id_key]
+# Args should be [separator, max_length, max_count, lock_key_prefix]
+# Returns the number of chunks queued.
+_slack_merge_script = redis_data.lua_script("""
+local separator, max_length, max_count = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local ids = redis.call('lrange', KEYS[1], 0, -1)
+local locked = {}
+local seen = {}
+local messages = {}
+local counts = {}
+for i = #ids, 1, -1 do
+    local id = ids[i]
+    if not seen[id] then
+        seen[id] = true
+        local message = redis.call('hget', KEYS[2], id)
+        if message then
+            if redis.call('exists', ARGV[4] .. id) == 1 then
+                table.insert(locked, id)
+            else
+                table.insert(messages, message)
+                table.insert(counts, tonumber(redis.call('hget', KEYS[3], id)) or 1)
+                redis.call('hdel', KEYS[2], id)
+                redis.call('hdel', KEYS[3], id)
+            end
+        end
+    end
+end
+redis.call('del', KEYS[1])
+for _, id in ipairs(locked) do
+    redis.call('lpush', KEYS[1], id)
+end
+
+local chunks = 0
+local chunk = {}
+local chunk_length = 0
+local chunk_count = 0
+local function queue_chunk()
+    if #chunk > 0 then
+        local merged = table.concat(chunk, separator)
+        local merged_id = tostring(redis.call('incr', KEYS[4]))
+        redis.call('hset', KEYS[2], merged_id, merged)
+        redis.call('lpush', KEYS[1], merged_id)
+        if chunk_count > 1 then
+            redis.call('hset', KEYS[3], merged_id, chunk_count)
+        end
+        chunks = chunks + 1
+        chunk = {}
+        chunk_length = 0
+        chunk_count = 0
+    end
+end
+for i, message in ipairs(messages) do
+    local new_length = chunk_length + #message
+    if #chunk > 0 then
+        new_length = new_length + #separator
+    end
+    if #chunk > 0 and (new_length > max_length or chunk_count + counts[i] > max_count) then
+        queue_chunk()
+        new_length = #message
+    end
+    table.insert(chunk, message)
+    chunk_length = new_length
+    chunk_count = chunk_count + counts[i]
+end
+queue_chunk()
+return chunks
 """)
 
 
 def merge_slack_queue():
     """
-    Merges all current messages in the slack queue into one message.
+    Merges the current messages in the slack queue into as few messages as possible, each under
+    SLACK_MAX_MESSAGE_LENGTH and with at most SLACK_MAX_MESSAGES_PER_CHUNK messages merged together. Each merged message
+    is sent and acknowledged on its own.
+    :return: The number of merged messages queued by this call. Messages locked by a worker sending them aren't counted.
     """
-    _slack_merge_script(
-        keys=[SLACK_QUEUE],
-        args=['\n\n'],
+    return _slack_merge_script(
+        keys=[_ids_key(SLACK_QUEUE), _payloads_key(SLACK_QUEUE), _counts_key(SLACK_QUEUE), _next_id_key(SLACK_QUEUE)],
+        args=['\n\n', app.config['SLACK_MAX_MESSAGE_LENGTH'], app.config['SLACK_MAX_MESSAGES_PER_CHUNK'],
+              _lock_key(SLACK_QUEUE, '')],
         client=redis_data.get_connection()
     )
 
 
 def pull_reportable_message(reporting_key):
     """
-    Pulls a raw string message to report
+    Pulls a raw string message to report. The message stays queued (moved to the back) until it's finished, and other
+    workers won't pull it until it's finished or released.
     :param reporting_key: SLACK_QUEUE or TWITTER_QUEUE
-    :return: A string message
+    :return: A tuple of (message_id, message), or None if the queue is empty.
     """
-    raw = redis_data.get_connection().rpoplpush(reporting_key, reporting_key)
-    if raw is None:
-        return None
-    else:
-        return raw.decode()
+    return _pull_message(reporting_key, blocking=False)
 
 
-def finish_reportable_message(reporting_key, message):
+def finish_reportable_message(reporting_key, message_id):
     """
     Marks a raw string message as reported.
     :param reporting_key: SLACK_QUEUE or TWITTER_QUEUE
-    :param message: The message to mark finished.
+    :param message_id: The ID of the message to mark finished, from pull_reportable_message.
+    """
+    _finish_message(reporting_key, message_id)
+
+
+def release_reportable_message(reporting_key, message_id):
+    """
+    Unlocks a message which couldn't be reported, so that it can be pulled again straight away.
+    :param reporting_key: SLACK_QUEUE or TWITTER_QUEUE
+    :param message_id: The ID of the message, from pull_reportable_message.
     """
-    redis_data.get_connection().lrem(reporting_key, 0, message)
+    redis_data.get_connection().delete(_lock_key(reporting_key, message_id))
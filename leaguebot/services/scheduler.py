@@ -0,0 +1,77 @@
+"""
+A small scheduler for running stages of work repeatedly, each on its own interval, in a single long-running process.
+"""
+import threading
+import time
+
+from leaguebot import app
+
+__all__ = ["Scheduler"]
+
+logger = app.logger
+
+
+class _Stage(object):
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = 0
+
+
+class Scheduler(object):
+    """
+    Runs each added stage every `interval` seconds until stopped.
+
+    Stages run one at a time, in the order they were added whenever several are due at once. An exception in one stage
+    is logged and the stage is tried again at its next interval, so one failing stage doesn't stop the others.
+    """
+
+    def __init__(self):
+        self._stages = []
+        self._stop_event = threading.Event()
+
+    def add_stage(self, name, func, interval):
+        """
+        :param name: Name used when logging.
+        :param func: Function to call, with no arguments.
+        :param interval: Seconds between the start of one run and the start of the next.
+        """
+        self._stages.append(_Stage(name, func, interval))
+
+    def stop(self):
+        """
+        Stops the scheduler once the currently running stage (if any) finishes. Safe to call from a signal handler.
+        """
+        self._stop_event.set()
+
+    @property
+    def stopped(self):
+        return self._stop_event.is_set()
+
+    def _run_stage(self, stage):
+        start = time.monotonic()
+        # Scheduled from the start of this run, so a slow stage doesn't push every later run back.
+        stage.next_run = start + stage.interval
+        try:
+            stage.func()
+        except Exception:
+            logger.exception("Error running stage {}.".format(stage.name))
+        logger.debug("Stage {} finished in {:.2f}s.".format(stage.name, time.monotonic() - start))
+
+    def run(self):
+        """
+        Runs stages as they come due until stop() is called.
+        """
+        while not self.stopped:
+            for stage in self._stages:
+                if self.stopped:
+                    break
+                if stage.next_run <= time.monotonic():
+                    self._run_stage(stage)
+            if self._stages:
+                wait = min(stage.next_run for stage in self._stages) - time.monotonic()
+            else:
+                wait = None
+            if wait is None or wait > 0:
+                self._stop_event.wait(wait)
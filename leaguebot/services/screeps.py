@@ -1,20 +1,51 @@
-from flask import g
 from leaguebot import app
-from leaguebot.services.cache import cache
-import screepsapi.screepsapi as screepsapi
+from leaguebot.services import http_client
+from leaguebot.services.tick_clock import TickClock
+from leaguebot.static_constants import ScreepsError
 
+# How far off, in ticks, the estimated game tick may be before the server is asked for it again.
+app.config.setdefault('TICK_CLOCK_MAX_ERROR', 2)
+# Number of server ticks used to estimate the tick rate.
+app.config.setdefault('TICK_CLOCK_SAMPLES', 5)
+# Most seconds to estimate the tick for without asking the server.
+app.config.setdefault('TICK_CLOCK_MAX_AGE', 300)
 
-def get_client():
-    conn = getattr(g, '_screeps_client', None)
-    if conn is None:
-        user = app.config['API_USERNAME'] or None
-        password = app.config['API_PASSWORD'] or None
-        api = screepsapi.API(user, password)
-        g._screeps_client = api
-    return g._screeps_client
+
+def api_get(path, **params):
+    """
+    Makes a request to the screeps.com API.
+    :param path: The endpoint, relative to /api/.
+    :return: The decoded response.
+    :raises ScreepsError: if the request fails.
+    """
+    url = app.config['SCREEPS_URL'] + 'api/' + path
+    result = http_client.get(url, params=params)
+    if not result.ok:
+        raise ScreepsError("{} ({}, at {})".format(result.text, result.status_code, result.url))
+    return result.json()
+
+
+def _fetch_time():
+    return int(api_get('game/time')['time'])
+
+
+_tick_clock = TickClock(
+    _fetch_time,
+    max_error=app.config['TICK_CLOCK_MAX_ERROR'],
+    samples=app.config['TICK_CLOCK_SAMPLES'],
+    max_age=app.config['TICK_CLOCK_MAX_AGE'],
+)
 
 
-@cache.cache(expire=4)
 def get_time():
-    client = get_client()
-    return client.time()
+    """
+    :return: The current game tick, extrapolated from recent ticks fetched from the server.
+    """
+    return _tick_clock.get_tick()
+
+
+def get_time_stats():
+    """
+    :return: See TickClock.get_stats.
+    """
+    return _tick_clock.get_stats()
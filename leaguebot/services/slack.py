@@ -1,6 +1,8 @@
 from slackclient import SlackClient
 from leaguebot import app
 
+# 'live' to post messages, or 'log' to only log them (for running against serve_fixtures, see routes/replay.py).
+app.config.setdefault('MESSAGE_SINK', 'live')
 
 SLACK_TOKEN = app.config['SLACK_TOKEN']
 slack_client = SlackClient(SLACK_TOKEN)
@@ -11,6 +13,9 @@ def send_slack_message(channel_id, message):
     Sends a slack message.
     :return: True if successful, false otherwise.
     """
+    if app.config['MESSAGE_SINK'] == 'log':
+        app.logger.info("Not posting slack message to {} (MESSAGE_SINK is 'log'): {}".format(channel_id, message))
+        return True
     result = slack_client.api_call(
         "chat.postMessage",
         channel=channel_id,
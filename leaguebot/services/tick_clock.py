@@ -0,0 +1,114 @@
+import math
+import threading
+import time
+from collections import deque
+
+__all__ = ["TickClock"]
+
+
+class TickClock(object):
+    """
+    A thread-safe estimate of the current game tick, extrapolated from a few samples of the server's tick.
+
+    The tick rate is fitted to the samples, and the clock only asks the server for the tick again once the estimate's
+    error bound grows past `max_error` ticks, or after `max_age` seconds without a sample.
+    """
+
+    def __init__(self, fetch_tick, max_error=2, samples=5, min_interval=4, max_age=300):
+        """
+        :param fetch_tick: Function returning the server's current tick.
+        :param max_error: The largest error bound, in ticks, before resyncing with the server.
+        :param samples: Number of samples used to fit the tick rate.
+        :param min_interval: Seconds for which a sample is reused before the tick rate is known.
+        :param max_age: Most seconds to extrapolate from the latest sample, however good the fit is.
+        """
+        self.fetch_tick = fetch_tick
+        self.max_error = max_error
+        self.min_interval = min_interval
+        self.max_age = max_age
+        # (monotonic time, tick) pairs, oldest first.
+        self._samples = deque(maxlen=samples)
+        self._rate = None
+        self._rate_error = None
+        self._drift = 0.0
+        self._syncs = 0
+        self._estimates = 0
+        self._lock = threading.Lock()
+
+    def _fit_locked(self):
+        """
+        Fits the tick rate (in ticks per second) to the samples with least squares.
+        """
+        if len(self._samples) < 2:
+            self._rate = self._rate_error = None
+            return
+        span = self._samples[-1][0] - self._samples[0][0]
+        if span <= 0:
+            self._rate = self._rate_error = None
+            return
+        mean_time = sum(sample_time for sample_time, _ in self._samples) / len(self._samples)
+        mean_tick = sum(tick for _, tick in self._samples) / len(self._samples)
+        covariance = sum((sample_time - mean_time) * (tick - mean_tick) for sample_time, tick in self._samples)
+        variance = sum((sample_time - mean_time) ** 2 for sample_time, _ in self._samples)
+        self._rate = covariance / variance
+        # Each sample is only accurate to a tick, so the fitted rate is off by up to two ticks over the samples' span.
+        self._rate_error = 2.0 / span
+
+    def _extrapolate_locked(self, now):
+        """
+        :return: A tuple of (estimated tick, error bound in ticks), or None if there's nothing to extrapolate from.
+        """
+        if not self._samples:
+            return None
+        last_time, last_tick = self._samples[-1]
+        elapsed = now - last_time
+        if self._rate is None:
+            if elapsed < self.min_interval:
+                return last_tick, 0
+            return None
+        if elapsed > self.max_age:
+            return None
+        return last_tick + elapsed * self._rate, 1 + elapsed * self._rate_error
+
+    def _sync_locked(self):
+        start = time.monotonic()
+        tick = self.fetch_tick()
+        now = (start + time.monotonic()) / 2
+        estimate = self._extrapolate_locked(now)
+        if estimate is not None and self._rate is not None:
+            self._drift = estimate[0] - tick
+            if abs(self._drift) > estimate[1]:
+                # The tick rate changed: samples from before then would only skew the fit.
+                self._samples.clear()
+        self._samples.append((now, tick))
+        self._fit_locked()
+        self._syncs += 1
+        return tick
+
+    def get_tick(self):
+        """
+        :return: The estimated current tick.
+        :rtype: int
+        """
+        with self._lock:
+            self._estimates += 1
+            estimate = self._extrapolate_locked(time.monotonic())
+            if estimate is None or estimate[1] > self.max_error:
+                return self._sync_locked()
+            return int(math.floor(estimate[0]))
+
+    def get_stats(self):
+        """
+        :return: A dict with the fitted tick rate (ticks per second, or None if not known yet), the drift found at the
+                 last resync (estimated minus actual tick), the current error bound in ticks, and counts of syncs and
+                 estimates.
+        """
+        with self._lock:
+            estimate = self._extrapolate_locked(time.monotonic())
+            return {
+                'rate': self._rate,
+                'drift': self._drift,
+                'error_bound': estimate[1] if estimate is not None else None,
+                'syncs': self._syncs,
+                'estimates': self._estimates,
+            }
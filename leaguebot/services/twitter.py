@@ -2,6 +2,10 @@ import twitter
 from leaguebot import app
 from flask import g
 
+# 'live' to post messages, or 'log' to only log them (for running against serve_fixtures, see routes/replay.py).
+app.config.setdefault('MESSAGE_SINK', 'live')
+
+
 def get_twitter():
     conn = getattr(g, '_twitter', None)
     if conn is None:
@@ -13,5 +17,8 @@ def get_twitter():
 
 
 def send_twitter_message(message):
+    if app.config['MESSAGE_SINK'] == 'log':
+        app.logger.info("Not posting tweet (MESSAGE_SINK is 'log'): {}".format(message))
+        return
     twitter = get_twitter()
     twitter.PostUpdate(message)
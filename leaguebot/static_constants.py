@@ -7,9 +7,21 @@ from leaguebot import app
 DATABASE_PREFIX = app.config.get('REDIS_PREFIX', 'leaguebot:')
 
 _VERSION = "0.2"
-PROCESSING_QUEUE = DATABASE_PREFIX + _VERSION + ":processing_queue"
+# The processing_queue list used before rooms were scheduled. Only read to move rooms queued by older versions over.
+LEGACY_PROCESSING_QUEUE = DATABASE_PREFIX + _VERSION + ":processing_queue"
+# Rooms waiting to be processed: a sorted set of room name scored by the earliest game tick at which processing them
+# could make progress.
+PROCESSING_SCHEDULE = DATABASE_PREFIX + _VERSION + ":processing_schedule"
 PROCESSING_QUEUE_SET = DATABASE_PREFIX + _VERSION + ":processing_set"
-
+# Rooms currently claimed by a worker: a sorted set of room name scored by lease expiry time, and a hash of room name to
+# the worker token holding the lease.
+PROCESSING_LEASES = DATABASE_PREFIX + _VERSION + ":processing_leases"
+PROCESSING_LEASE_OWNERS = DATABASE_PREFIX + _VERSION + ":processing_lease_owners"
+
+# Message queues. Each one keeps a list of message IDs at "<queue>:ids", a hash of message ID to message at
+# "<queue>:payloads", and a counter new message IDs are taken from at "<queue>:next-id" (see redis_queue). The
+# "<queue>" key itself is the plain list used by older versions, only read to move messages queued by them over. The
+# Slack and Twitter queues' rate limits are kept at "<queue>:rate-limit" (see reporting).
 REPORTING_QUEUE = DATABASE_PREFIX + _VERSION + ":reporting_queue"
 
 SLACK_QUEUE = DATABASE_PREFIX + _VERSION + ":slack_queue"
@@ -19,13 +31,21 @@ TWITTER_QUEUE = DATABASE_PREFIX + _VERSION + ":twitter_queue"
 USERNAME_CACHE_KEY = DATABASE_PREFIX + "cache:username:{}"
 USERNAME_CACHE_EXPIRE = 60 * 60 * 5
 
-ALLIANCE_CACHE_KEY = DATABASE_PREFIX + "cache:alliance:{}"
-ALLIANCE_CACHE_EXPIRE = 60 * 60 * 5
+# Hash of alliance abbreviation to JSON {"name": ..., "members": [...]}, from LOAN's alliances.js. Only alliances which
+# changed are written each time it's fetched, and the version is incremented whenever any did, so that processes can
+# tell when their copy is out of date.
+ALLIANCE_DATA_KEY = DATABASE_PREFIX + "alliance-data"
+ALLIANCE_DATA_VERSION_KEY = DATABASE_PREFIX + "alliance-data:version"
+# The ETag and Last-Modified headers alliances.js was last fetched with, for conditional requests.
+ALLIANCE_DATA_VALIDATORS_KEY = DATABASE_PREFIX + "alliance-data:validators"
+ALLIANCE_DATA_FETCHED_KEY = DATABASE_PREFIX + "alliance-data:fetched"
 
-ALLIANCES_FETCHED_KEY = DATABASE_PREFIX + "fetched-alliance-cache"
-ALLIANCES_FETCHED_EXPIRE = 60 * 60 * 4
+SHORT_LINK_CACHE_KEY = DATABASE_PREFIX + "cache:short-link:{}"
+SHORT_LINK_CACHE_EXPIRE = 60 * 60 * 24 * 30
 
 BATTLE_DATA_KEY = DATABASE_PREFIX + "ongoing-data:{}"
+# Set of creep IDs already counted for the battle data at BATTLE_DATA_KEY. Expires with BATTLE_DATA_EXPIRE.
+BATTLE_CREEPS_KEY = DATABASE_PREFIX + "ongoing-creeps:{}"
 # if it's still in here for 3 days, something has gone wrong and we can just get rid of it.
 BATTLE_DATA_EXPIRE = 60 * 60 * 24 * 3
 
@@ -35,6 +55,10 @@ ROOM_LAST_BATTLE_END_TICK_EXPIRE = 60 * 60 * 24 * 10
 LAST_CHECKED_TICK_KEY = DATABASE_PREFIX + "last-checked-tick"
 LAST_CHECKED_TICK_EXPIRE = 60 * 60
 
+# Stores the tick after which a history segment which returned a 404 error is worth requesting again.
+HISTORY_MISSING_KEY = DATABASE_PREFIX + "history-missing:{}:{}"
+HISTORY_MISSING_EXPIRE = 60 * 60
+
 ####
 # Predefined settings (should these be configurable?)
 ####
@@ -50,6 +74,12 @@ after the last known hostilities (or the first hostilities if no history has bee
 """
 KEEP_IN_QUEUE_FOR_MAX_TICKS_UNSUCCESSFUL = 200
 
+"""
+After a history segment is found missing, don't request it again until at least this many more ticks have passed (or
+the segment's last tick has passed, if that's later).
+"""
+HISTORY_MISSING_RETRY_TICKS = 20
+
 CHECK_BATTLES_ENDPOINT_EVERY_SECONDS = 15 * 60
 
 ####